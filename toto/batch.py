@@ -0,0 +1,163 @@
+'''``toto.batch`` runs the requests in a batch. It is used by ``TotoHandler`` to process every batch, one
+request at a time by default or concurrently when the server is run with ``--batch_mode=concurrent``.
+
+Each request in the batch is invoked with a ``BatchItemHandler`` in place of the ``TotoHandler``. The item
+handler behaves like the request handler it wraps, but calls to ``respond()``, ``respond_raw()`` and
+``finish()`` complete that item of the batch instead of the HTTP request. This allows ``@asynchronous``
+methods to contribute results to a batch. ``@streaming`` methods can't be batched and respond to their item
+with an ``ERROR_SERVER`` error. The batch response is sent once every item has completed or
+``--batch_timeout`` has passed.
+
+If ``--batch_threads`` is greater than zero, synchronous methods will run on a shared ``TaskQueue`` so that
+blocking methods in the same batch can run in parallel. Methods run this way must be thread safe and must
+not write to the response stream directly. Every item shares the batch request's session, so methods that
+load the session (e.g. ``@authenticated``) always run on the ``IOLoop`` and methods that run in parallel must
+not retrieve or save the session themselves.
+'''
+
+from tornado.ioloop import IOLoop
+from collections import deque
+from time import time
+from exceptions import *
+from tasks import Future
+
+class BatchItemHandler(object):
+  '''A stand-in for the ``TotoHandler`` processing a batch, passed to the method invoked for the item
+  stored under ``key``. Any attributes not defined here are read from the wrapped handler.
+  '''
+
+  def __init__(self, handler, key, batch):
+    self._handler = handler
+    self._key = key
+    self._batch = batch
+    self._finished = False
+    self._write_buffer = []
+    self.resolved_method = None
+    self.response_type = handler.response_type
+
+  def __getattr__(self, name):
+    return getattr(self._handler, name)
+
+  def respond(self, result=None, error=None, batch_results=None):
+    self._finished = True
+    self._batch.complete(self._key, result, error)
+
+  def respond_future(self, future):
+    def respond(future):
+      try:
+        result = future.result()
+      except Exception as e:
+        self.respond(error=e)
+        return
+      self.respond(result)
+    future.add_done_callback(respond)
+
+  def respond_raw(self, body, content_type, finish=True):
+    self.response_type = content_type
+    self.write(body)
+    if finish:
+      self.finish()
+
+  def respond_stream(self, iterable, raw=False):
+    self.respond(error=TotoException(ERROR_SERVER, "Streaming methods can't be called in a batch."))
+
+  def write(self, chunk):
+    self._write_buffer.append(chunk)
+
+  def flush(self, *args, **kwargs):
+    pass
+
+  def finish(self, chunk=None):
+    if chunk is not None:
+      self.write(chunk)
+    self._finished = True
+    self._batch.complete(self._key, self._write_buffer and ''.join(self._write_buffer) or None, None)
+
+class BatchRequest(object):
+  '''Invokes every request in ``requests`` (a dictionary of request bodies) on behalf of ``handler``, running
+  at most ``concurrency`` at a time (or all at once if ``concurrency`` is zero). If ``timeout`` is non-zero,
+  items that have not completed after ``timeout`` seconds will respond with an ``ERROR_TIMEOUT`` error.
+  Synchronous methods will run on ``task_queue`` if it is set. Call ``start()`` to begin processing.
+  '''
+
+  def __init__(self, handler, requests, concurrency=0, timeout=0, task_queue=None):
+    self.__handler = handler
+    self.__queue = deque(sorted(requests.iteritems()))
+    self.__keys = set(requests)
+    self.__concurrency = concurrency > 0 and concurrency or len(self.__queue)
+    self.__timeout = timeout
+    self.__timeout_handle = None
+    self.__task_queue = task_queue
+    self.__io_loop = IOLoop.instance()
+    self.__active = 0
+    self.__results = {}
+    self.__finished = False
+
+  def start(self):
+    if self.__timeout > 0:
+      self.__timeout_handle = self.__io_loop.add_timeout(time() + self.__timeout, self.__expire)
+    if not self.__keys:
+      self.__finish()
+    else:
+      self.__run_queued()
+
+  def complete(self, key, result=None, error=None):
+    '''Record the result of the request stored under ``key``. This method is thread safe.'''
+    self.__io_loop.add_callback(lambda: self.__complete(key, result, error))
+
+  def __complete(self, key, result, error):
+    if self.__finished or key in self.__results:
+      return
+    if error:
+      self.__results[key] = {'error': isinstance(error, dict) and error or self.__handler.error_info(error)}
+    else:
+      self.__results[key] = {'result': result}
+    self.__active -= 1
+    if len(self.__results) == len(self.__keys):
+      self.__finish()
+    else:
+      self.__run_queued()
+
+  def __run_queued(self):
+    while self.__queue and self.__active < self.__concurrency:
+      key, request = self.__queue.popleft()
+      self.__active += 1
+      self.__run(key, request)
+
+  def __run(self, key, request):
+    item = BatchItemHandler(self.__handler, key, self)
+    try:
+      method = self.__handler.get_method(None, request)
+    except Exception as e:
+      self.complete(key, None, e)
+      return
+    if method.streaming:
+      self.complete(key, None, TotoException(ERROR_SERVER, "Streaming methods can't be called in a batch."))
+      return
+    #items share the handler's session, so only run methods in parallel if they don't load it
+    if self.__task_queue is not None and not (method.asynchronous or method.loads_session):
+      self.__task_queue.add_task(self.__invoke, item, request)
+    else:
+      self.__invoke(item, request)
+
+  def __invoke(self, item, request):
+    (result, error, finish_by_default) = self.__handler.invoke_method(None, request, request.get('parameters') or {}, handler=item)
+    if isinstance(result, Future):
+      item.respond_future(result)
+    elif result is not None or error or (finish_by_default and not item._finished):
+      item.respond(result, error)
+
+  def __expire(self):
+    self.__timeout_handle = None
+    for key in self.__keys:
+      if key not in self.__results:
+        self.__results[key] = {'error': self.__handler.error_info(TotoException(ERROR_TIMEOUT, "Timed out"))}
+    self.__finish()
+
+  def __finish(self):
+    self.__finished = True
+    if self.__timeout_handle:
+      self.__io_loop.remove_timeout(self.__timeout_handle)
+      self.__timeout_handle = None
+    if not self.__handler._finished:
+      self.__handler.respond(batch_results=self.__results)
@@ -1,9 +1,9 @@
 from tornado.web import *
-import json
 from invocation import *
 from exceptions import *
 from tornado.options import define, options
 from events import EventManager
+import serialization
 from tornado.websocket import WebSocketHandler
 import logging
 from collections import deque
@@ -82,7 +82,7 @@ class ClientSideWorkerSocketHandler(WebSocketHandler):
     ClientSideWorkerManager.instance().add_worker(self)
 
   def on_message(self, message_data):
-    message = json.loads(message_data)
+    message = serialization.JSON.loads(message_data)
     ClientSideWorkerManager.instance().finish_operation(self, message['operation_id'], message['result'])
 
   def on_close(self):
@@ -0,0 +1,162 @@
+'''``CPUPool`` runs ``@cpu_bound`` invoke functions in a pool of local processes so CPU heavy methods don't block the
+``IOLoop``. When the server is run with ``--cpu_pool_processes`` greater than zero, ``TotoServer`` starts the pool
+before the server processes are forked and every server process shares it. Tasks are sent to the pool through a
+shared queue and each server process receives its results on a queue of its own. Result queues are created by a
+``multiprocessing`` manager when a process attaches, so processes started by a reload or restart never share a
+queue with the process they replace.
+
+Parameters and results are pickled, so they must be picklable. The method's module is imported in the pool process
+the first time it is used there. When the server reloads, the pool processes are replaced along with the server
+processes so they import the reloaded method modules. Without a pool, ``@cpu_bound`` methods run on the calling
+thread.
+'''
+
+import sys
+import signal
+import logging
+from multiprocessing import Process, Queue
+from multiprocessing.managers import SyncManager
+from threading import Thread, Lock, Timer
+from itertools import count
+from traceback import format_exc
+from tornado.options import define, options
+from tasks import Future
+from exceptions import *
+
+define("cpu_pool_processes", default=0, help="The number of processes to start for methods decorated with @cpu_bound. If zero, @cpu_bound methods run on the IOLoop thread")
+
+def _resolve(module_name):
+  #the undecorated function may be wrapped by other decorators, so find it through the method's invoke function
+  __import__(module_name)
+  return sys.modules[module_name].invoke.cpu_bound
+
+def _work(tasks):
+  #pool processes may be forked by the supervising process after it installed its signal handlers
+  for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGCHLD):
+    signal.signal(signum, signal.SIG_DFL)
+  while 1:
+    task = tasks.get()
+    if task is None:
+      return
+    results, task_id, module_name, parameters = task
+    #errors are sent as (code, value) because TotoException can't be unpickled
+    try:
+      result = (task_id, _resolve(module_name)(None, parameters), None)
+    except TotoException as e:
+      result = (task_id, None, (e.code, e.value))
+    except Exception as e:
+      logging.error(format_exc())
+      result = (task_id, None, (ERROR_SERVER, str(e)))
+    try:
+      results.put(result)
+    except Exception as e:
+      results.put((task_id, None, (ERROR_SERVER, "Unable to send result: %s" % e)))
+
+class CPUPool(object):
+  '''A pool of ``processes`` worker processes shared by any number of server processes. Call ``start()`` before
+  forking the server processes, then call ``attach()`` in each server process.
+  '''
+
+  def __init__(self, processes):
+    self.processes = processes
+    self.__tasks = Queue()
+    self.__manager = None
+    self.__results = None
+    self.__workers = []
+    self.__futures = {}
+    self.__lock = Lock()
+    self.__ids = count()
+
+  def start(self, manager=None):
+    if manager is None:
+      manager = SyncManager()
+      manager.start()
+    self.__manager = manager
+    for i in xrange(self.processes):
+      worker = Process(target=_work, args=(self.__tasks,))
+      worker.daemon = True
+      worker.start()
+      self.__workers.append(worker)
+
+  def attach(self):
+    '''Start receiving results in this server process.'''
+    self.__results = self.__manager.Queue()
+    thread = Thread(target=self.__receive_results, args=(self.__results,))
+    thread.daemon = True
+    thread.start()
+
+  def __receive_results(self, results):
+    while 1:
+      try:
+        task_id, result, error = results.get()
+      except (EOFError, IOError):
+        #the manager has shut down
+        return
+      with self.__lock:
+        future = self.__futures.pop(task_id, None)
+      if not future:
+        continue
+      if error:
+        future.set_exception(TotoException(*error))
+      else:
+        future.set_result(result)
+
+  def submit(self, module_name, parameters):
+    '''Returns a ``toto.tasks.Future`` for the result of calling the ``@cpu_bound`` invoke function of the method
+    module ``module_name`` with ``(None, parameters)`` in the pool.
+    '''
+    future = Future()
+    task_id = next(self.__ids)
+    with self.__lock:
+      self.__futures[task_id] = future
+    self.__tasks.put((self.__results, task_id, module_name, parameters))
+    return future
+
+  def stop(self, shutdown_manager=True):
+    '''Stop the pool processes once the tasks already queued have run. Unless ``shutdown_manager`` is ``False``,
+    the result queues are closed immediately.
+    '''
+    for worker in self.__workers:
+      self.__tasks.put(None)
+    if shutdown_manager and self.__manager:
+      self.__manager.shutdown()
+
+  @classmethod
+  def run(cls, fn, parameters, module_name):
+    '''Returns a ``toto.tasks.Future`` for the result of ``fn(None, parameters)``, where ``fn`` is the ``@cpu_bound``
+    invoke function of the method module ``module_name``. ``fn`` is run in the shared pool if one has been
+    attached in this process and on the calling thread otherwise.
+    '''
+    pool = getattr(cls, '_instance', None)
+    if pool and pool.__results is not None:
+      return pool.submit(module_name, parameters)
+    future = Future()
+    try:
+      future.set_result(fn(None, parameters))
+    except Exception as e:
+      future.set_exception(e)
+    return future
+
+  @classmethod
+  def reload(cls, retire_after=0):
+    '''Replace the configured pool with a new one so ``@cpu_bound`` methods run the latest code after the method
+    modules are reimported. Call ``reload()`` before forking the new server processes. The old pool keeps serving
+    the old server processes for ``retire_after`` seconds and is then stopped once its queued tasks have run.
+    '''
+    pool = cls.instance()
+    if not pool:
+      return
+    cls._instance = cls(pool.processes)
+    cls._instance.start(pool.__manager)
+    timer = Timer(retire_after, pool.stop, (False,))
+    timer.daemon = True
+    timer.start()
+
+  @classmethod
+  def instance(cls):
+    '''Returns the pool configured with ``--cpu_pool_processes``, or ``None`` if ``--cpu_pool_processes`` is zero.'''
+    if not options.cpu_pool_processes:
+      return None
+    if not hasattr(cls, '_instance'):
+      cls._instance = cls(options.cpu_pool_processes)
+    return cls._instance
@@ -29,11 +29,14 @@ class DBConnection(object):
     '''
     raise NotImplementedError()
 
-  def retrieve_session(self, session_id, hmac_data=None, data=None):
+  def retrieve_session(self, session_id, hmac_data=None, data=None, account_fields=None):
     '''Retrieve an existing session with the given ``session_id``. Pass the request body and the value
     of the ``x-toto-hmac`` header as ``data`` and ``hmac_data`` respectively to verify an authenticated request.
     If ``hmac_data`` and ``data`` are both ``None``, HMAC verification will be skipped. This method returns a
     subclasses of ``TotoSession`` designed for the current backing database.
+
+    Pass a list of account properties as ``account_fields`` to load them along with the session, they will be
+    available from ``session.get_account()`` without further queries.
     '''
     raise NotImplementedError()
 
@@ -60,6 +63,82 @@ class DBConnection(object):
     '''
     raise NotImplementedError()
 
+  _executor = None
+  async_thread_limit = 0
+
+  def enable_async(self, thread_count):
+    '''Run the ``*_async`` methods of this connection on a ``toto.tasks.TaskQueue`` with up to ``thread_count``
+    threads (limited by ``async_thread_limit`` if the driver sets it). Until this is called, the ``*_async``
+    methods run synchronously and return completed futures.
+    '''
+    from tasks import TaskQueue
+    if self.async_thread_limit:
+      thread_count = min(thread_count, self.async_thread_limit)
+    self._executor = TaskQueue(thread_count)
+
+  def run_async(self, fn, *args, **kwargs):
+    '''Call ``fn(*args, **kwargs)`` on this connection's executor and return a ``toto.tasks.Future`` for the result.
+    Use this to keep blocking queries in method bodies off the ``IOLoop``::
+
+      @asynchronous
+      def invoke(handler, parameters):
+        def respond(future):
+          handler.respond(result=future.result())
+        handler.db_connection.run_async(handler.db.query, 'select * from log').add_done_callback(respond)
+    '''
+    if self._executor is not None:
+      return self._executor.submit(fn, *args, **kwargs)
+    from tasks import Future
+    future = Future()
+    try:
+      future.set_result(fn(*args, **kwargs))
+    except Exception as e:
+      future.set_exception(e)
+    return future
+
+  def create_account_async(self, user_id, password, additional_values={}, **values):
+    '''Like ``create_account`` but returns a ``toto.tasks.Future``.'''
+    return self.run_async(self.create_account, user_id, password, additional_values, **values)
+
+  def create_session_async(self, user_id=None, password=None, verify_password=True):
+    '''Like ``create_session`` but returns a ``toto.tasks.Future``.'''
+    return self.run_async(self.create_session, user_id, password, verify_password)
+
+  def retrieve_session_async(self, session_id, hmac_data=None, data=None, account_fields=None):
+    '''Like ``retrieve_session`` but returns a ``toto.tasks.Future``.'''
+    return self.run_async(self.retrieve_session, session_id, hmac_data, data, account_fields)
+
+  def remove_session_async(self, session_id):
+    '''Like ``remove_session`` but returns a ``toto.tasks.Future``.'''
+    return self.run_async(self.remove_session, session_id)
+
+  def clear_sessions_async(self, user_id):
+    '''Like ``clear_sessions`` but returns a ``toto.tasks.Future``.'''
+    return self.run_async(self.clear_sessions, user_id)
+
+  def change_password_async(self, user_id, password, new_password):
+    '''Like ``change_password`` but returns a ``toto.tasks.Future``.'''
+    return self.run_async(self.change_password, user_id, password, new_password)
+
+  def generate_password_async(self, user_id):
+    '''Like ``generate_password`` but returns a ``toto.tasks.Future``.'''
+    return self.run_async(self.generate_password, user_id)
+
+  _session_renewer = None
+
+  def enable_lazy_renewal(self, interval):
+    '''Queue session renewals and write them to the database in bulk every ``interval`` seconds instead
+    of extending sessions as they are retrieved. See ``toto.sessionrenewer.SessionRenewer``.
+    '''
+    from sessionrenewer import SessionRenewer
+    self._session_renewer = SessionRenewer(self, interval)
+
+  def _renew_sessions(self, session_ids, ttl):
+    '''Drivers supporting lazy renewal implement this method to extend all sessions in ``session_ids``
+    to expire ``ttl`` seconds from now in as few operations as possible.
+    '''
+    raise NotImplementedError()
+
 from tornado.options import define, options
 
 define("database", metavar='mysql|mongodb|redis|postgres|none', default="none", help="the database driver to use")
@@ -80,8 +159,24 @@ define("session_ttl", default=24*60*60*365, help="The number of seconds after cr
 define("anon_session_ttl", default=24*60*60, help="The number of seconds after creation an anonymous session should expire")
 define("session_renew", default=0, help="The number of seconds before a session expires that it should be renewed, or zero to renew on every request")
 define("anon_session_renew", default=0, help="The number of seconds before an anonymous session expires that it should be renewed, or zero to renew on every request")
+define("session_renew_interval", default=0, help="If greater than zero, session renewals will be queued and written to the database in bulk every session_renew_interval seconds instead of on each request")
+define("db_async", default=False, help="Run session loading for the authentication decorators and the *_async methods of the database connection on a pool of db_threads threads so the database does not block the IOLoop")
+define("db_threads", default=10, help="The maximum number of threads to use for database access with --db_async")
+define("session_cache_size", default=0, help="The maximum number of sessions to cache in each process, or zero to disable session caching")
+define("session_cache_ttl", default=60, help="The number of seconds a session may be served from the session cache before it is reloaded from the database")
+
+def configured_connection():
+    connection = _configured_connection()
+    if options.session_renew_interval > 0:
+      connection.enable_lazy_renewal(options.session_renew_interval)
+    if options.session_cache_size > 0:
+      from sessioncache import CachedSessionConnection
+      connection = CachedSessionConnection(connection, options.session_cache_size, options.session_cache_ttl)
+    if options.db_async:
+      connection.enable_async(options.db_threads)
+    return connection
 
-def configured_connection():  
+def _configured_connection():
     if options.database == "mongodb":
       from mongodbconnection import MongoDBConnection
       return MongoDBConnection(options.db_host, options.db_port or 27017, options.mongodb_database, options.session_ttl, options.anon_session_ttl, options.session_renew, options.anon_session_renew)
@@ -1,10 +1,27 @@
 '''Toto's event framework is used to allow external events to affect client requests, or to run scheduled tasks
 after a specified signal is received. It can be used to send messages to active requests, even between multiple
 server processes. The event framework can also be used outside of Toto to send messages to running Toto servers.
+
+By default, incoming events are read on Tornado's main ``IOLoop``. Pending events are drained in batches of up to
+``EventManager.batch_size`` messages and each event is decoded once, regardless of the number of handlers registered
+for it. Handlers that do not need the main loop can be moved off the ``IOLoop`` by listening on a background thread
+instead, see ``EventManager.start_listening()``.
+
+With ``routing='subscription'`` (``--event_routing=subscription``), events are only delivered to servers that have
+handlers for them. Each receiver binds a ZMQ SUB socket and subscribes to the names of the events it currently has
+handlers for, and each sender publishes to every peer with an XPUB socket, so events are filtered before they are sent.
+Subscriptions are updated as handlers are registered and removed. ZMQ matches subscriptions by prefix, so topics are
+terminated with a null byte and a server with handlers for "chat" does not receive "chat.typing". Senders track the
+subscriptions of each peer, so non-broadcast events are only sent to a server that is subscribed to them. All servers
+and senders sharing events must use the same routing mode.
+
+Events are sent in the legacy format unless ``EventManager.wire_format`` is set to a ``toto.wireformat.WireFormat``
+(``--wire_format=framed``). Both formats are always accepted, and the payload of a framed event is only decoded if
+there are handlers for it.
 '''
 
 import cPickle as pickle
-from threading import Thread
+from threading import Thread, Lock
 from collections import deque
 from tornado.web import *
 from tornado.ioloop import IOLoop
@@ -13,18 +30,106 @@ from tornado.options import options
 import zmq
 import logging
 import zlib
+import wireformat
+from time import time
+from sys import getsizeof
 from random import choice, shuffle
 
+def _topic(event_name):
+  #terminated so subscriptions, which match by prefix, only match the exact event name
+  return (isinstance(event_name, unicode) and event_name.encode('utf-8') or event_name) + '\x00'
+
+class _CoalescedHandler(object):
+  '''Collects the events received for ``event_handler`` and delivers them in a single call on the main ``IOLoop``.
+  See ``EventManager.register_handler()``.
+  '''
+
+  def __init__(self, manager, event_handler, mode, window, max_batch, request_handler, persist):
+    if mode not in ('latest', 'list'):
+      raise ValueError("Unsupported coalesce mode: %s" % mode)
+    self.manager = manager
+    self.event_handler = event_handler
+    self.mode = mode
+    self.window = window
+    self.max_batch = max_batch
+    self.request_handler = request_handler
+    self.persist = persist
+    self.sig = None
+    self.__lock = Lock()
+    self.__pending = []
+    self.__scheduled = False
+    self.__timeout = None
+    self.__cancelled = False
+
+  def __call__(self, event_args):
+    with self.__lock:
+      if self.mode == 'latest':
+        self.__pending = [event_args]
+      else:
+        self.__pending.append(event_args)
+      full = self.max_batch and len(self.__pending) >= self.max_batch
+      if self.__scheduled and not full:
+        return
+      self.__scheduled = True
+    IOLoop.instance().add_callback(full and self.flush or self.__schedule)
+
+  def __schedule(self):
+    if not self.window:
+      self.flush()
+      return
+    with self.__lock:
+      if self.__scheduled and not self.__timeout:
+        self.__timeout = IOLoop.instance().add_timeout(time() + self.window, self.flush)
+
+  def cancel(self):
+    self.__cancelled = True
+
+  def flush(self):
+    '''Deliver the collected events now. Must be called on the main ``IOLoop``.'''
+    with self.__lock:
+      pending, self.__pending = self.__pending, []
+      if self.max_batch and len(pending) > self.max_batch:
+        pending, self.__pending = pending[:self.max_batch], pending[self.max_batch:]
+      timeout, self.__timeout = self.__timeout, None
+      self.__scheduled = bool(self.__pending)
+    if timeout:
+      IOLoop.instance().remove_timeout(timeout)
+    if self.__scheduled:
+      IOLoop.instance().add_callback(self.flush)
+    if not pending or self.__cancelled:
+      return
+    if not self.persist:
+      self.manager.remove_handler(self.sig)
+    if self.request_handler and self.request_handler._finished:
+      return
+    try:
+      self.event_handler(self.mode == 'latest' and pending[0] or pending)
+    except Exception as e:
+      logging.error(format_exc())
+
 class EventManager():
-  '''Instances will listen on ``address`` for incoming events.
+  '''Instances will listen on ``address`` for incoming events. ``routing`` may be "broadcast" (the default) to
+  send every event to every registered server, or "subscription" to send events only to servers with
+  handlers registered for them.
   '''
 
-  def __init__(self, address=None):
+  #the maximum number of events to read before yielding to other IOLoop callbacks
+  batch_size = 256
+
+  def __init__(self, address=None, routing='broadcast'):
     self.__handlers = {}
+    self.__request_handlers = {}
+    self.__handlers_lock = Lock()
+    self.__subscriptions = set()
+    self.__changed_subscriptions = set()
     self.address = address
+    self.routing = routing
+    self.wire_format = None
     self.__zmq_context = zmq.Context()
     self.__remote_servers = {}
+    self.__peer_topics = {}
     self.__thread = None
+    self.__socket = None
     self.__queued_servers = deque()
   
   def register_server(self, address):
@@ -33,22 +138,24 @@ class EventManager():
     '''
     if address in self.__remote_servers:
       raise Exception('Server already registered: %s', address)
-    socket = self.__zmq_context.socket(zmq.PUSH)
+    socket = self.__zmq_context.socket(self.routing == 'subscription' and zmq.XPUB or zmq.PUSH)
     socket.connect(address)
     self.__remote_servers[address] = socket
+    self.__peer_topics[socket] = set()
     self.refresh_server_queue()
 
   def remove_server(self, address):
     '''Remove the server located at ``address`` from the recipient list for all
     future calls to ``send()``.
     '''
-    del self.__remote_servers[address]
+    self.__peer_topics.pop(self.__remote_servers.pop(address), None)
     self.refresh_server_queue()
     
   def remove_all_servers(self):
     '''Clear the recipient list for all future calls to ``send``.
     '''
     self.__remote_servers.clear()
+    self.__peer_topics.clear()
     self.refresh_server_queue()
 
   def refresh_server_queue(self):
@@ -59,54 +166,234 @@ class EventManager():
     self.__queued_servers.extend(self.__remote_servers.itervalues())
     shuffle(self.__queued_servers)
   
-  def register_handler(self, event_name, event_handler, run_on_main_loop=False, request_handler=None, persist=False):
+  def register_handler(self, event_name, event_handler, run_on_main_loop=False, request_handler=None, persist=False, coalesce=None, window=0, max_batch=0):
     '''Register ``event_handler`` to run when ``event_name`` is received. Handlers are meant to respond to
     a single event matching ``event_name`` only. If ``run_on_main_loop`` is ``True`` the handler will be executed
     on Tornado's main ``IOLoop`` (required if the handler will write to a response stream). If ``request_handler``
     is set, ``event_handler`` will not fire once ``request_handler`` has finished. Set ``persist`` to ``True``
     to automatically requeue ``event_handler`` each time it is executed.
+
+    High frequency events can be coalesced by setting ``coalesce`` to "latest" (``event_handler`` receives the
+    arguments of the most recent event only) or "list" (``event_handler`` receives a list of the arguments of
+    every event received). Events are collected for ``window`` seconds after the first one arrives, or until the
+    end of the current batch of events if ``window`` is zero. With "list", the events are delivered as soon as
+    ``max_batch`` have been collected if ``max_batch`` is non-zero. Coalesced handlers always run on the main
+    ``IOLoop``.
     '''
-    if not event_name in self.__handlers:
-      self.__handlers[event_name] = set()
+    if coalesce:
+      event_handler = _CoalescedHandler(self, event_handler, coalesce, window, max_batch, request_handler, persist)
+      #the coalesced handler stays registered until it has delivered its events
+      run_on_main_loop, persist = False, True
     handler_tuple = (event_handler, run_on_main_loop, request_handler, persist)
-    self.__handlers[event_name].add(handler_tuple)
+    with self.__handlers_lock:
+      if not event_name in self.__handlers:
+        self.__handlers[event_name] = set()
+        self.__subscription_changed(event_name)
+      self.__handlers[event_name].add(handler_tuple)
+      if request_handler is not None:
+        self.__request_handlers.setdefault(request_handler, set()).add((event_name, handler_tuple))
+    if coalesce:
+      event_handler.sig = (event_name, handler_tuple)
     return (event_name, handler_tuple)
 
   def remove_handler(self, handler_sig):
     '''Disable and remove the handler matching ``handler_sig``.
     '''
-    self.__handlers[handler_sig[0]].discard(handler_sig[1])
-  
-  def start_listening(self):
-    '''Starts listening for incoming events on ``EventManager.address``.
+    if isinstance(handler_sig[1][0], _CoalescedHandler):
+      handler_sig[1][0].cancel()
+    with self.__handlers_lock:
+      self.__remove_handler(*handler_sig)
+
+  def remove_request_handler(self, request_handler):
+    '''Remove every event handler registered with ``request_handler``. ``TotoHandler`` and ``TotoSocketHandler``
+    call this when they finish so that handlers for closed connections do not accumulate.
     '''
-    if self.__thread:
+    with self.__handlers_lock:
+      sigs = self.__request_handlers.pop(request_handler, ())
+      for event_name, handler_tuple in sigs:
+        if isinstance(handler_tuple[0], _CoalescedHandler):
+          handler_tuple[0].cancel()
+        self.__remove_handler(event_name, handler_tuple)
+
+  def __remove_handler(self, event_name, handler_tuple):
+    #must be called with the handler lock held
+    handlers = self.__handlers.get(event_name)
+    if handlers:
+      handlers.discard(handler_tuple)
+      if not handlers:
+        del self.__handlers[event_name]
+        self.__subscription_changed(event_name)
+    request_handler = handler_tuple[2]
+    if request_handler is not None:
+      sigs = self.__request_handlers.get(request_handler)
+      if sigs:
+        sigs.discard((event_name, handler_tuple))
+        if not sigs:
+          del self.__request_handlers[request_handler]
+
+  def __take_handlers(self, event_name):
+    with self.__handlers_lock:
+      handlers = self.__handlers.get(event_name)
+      if not handlers:
+        return ()
+      selected = []
+      for handler in list(handlers):
+        if handler[2] is not None and handler[2]._finished:
+          self.__remove_handler(event_name, handler)
+          continue
+        selected.append(handler)
+        if not handler[3]:
+          self.__remove_handler(event_name, handler)
+    return selected
+
+  def registry_info(self):
+    '''Returns a dictionary describing the handler registry: the number of event names with handlers, the total
+    number of registered handlers, the number of request handlers with registered event handlers and the approximate
+    memory used by the registry tables in bytes.
+    '''
+    with self.__handlers_lock:
+      handler_count = sum(len(h) for h in self.__handlers.itervalues())
+      size = getsizeof(self.__handlers) + getsizeof(self.__request_handlers)
+      size += sum(getsizeof(h) + sum(getsizeof(t) for t in h) for h in self.__handlers.itervalues())
+      size += sum(getsizeof(s) + sum(getsizeof(sig) for sig in s) for s in self.__request_handlers.itervalues())
+      return {'events': len(self.__handlers), 'handlers': handler_count, 'request_handlers': len(self.__request_handlers), 'bytes': size}
+
+  def __subscription_changed(self, event_name):
+    #called with the handler lock held, changes are applied by the receiving thread so that
+    #handlers removed and registered again in quick succession do not cause any subscription traffic
+    if self.routing != 'subscription':
+      return
+    if not self.__changed_subscriptions and self.__socket:
+      IOLoop.instance().add_callback(self.__update_subscriptions)
+    self.__changed_subscriptions.add(event_name)
+
+  def __update_subscriptions(self, socket=None):
+    socket = socket or self.__socket
+    with self.__handlers_lock:
+      changed, self.__changed_subscriptions = self.__changed_subscriptions, set()
+      for event_name in changed:
+        if event_name in self.__handlers and event_name not in self.__subscriptions:
+          socket.setsockopt(zmq.SUBSCRIBE, _topic(event_name))
+          self.__subscriptions.add(event_name)
+        elif event_name not in self.__handlers and event_name in self.__subscriptions:
+          socket.setsockopt(zmq.UNSUBSCRIBE, _topic(event_name))
+          self.__subscriptions.discard(event_name)
+
+  def __subscribed(self, socket, topic):
+    #XPUB sockets receive the subscribe (\x01) and unsubscribe (\x00) messages of the connected peer
+    topics = self.__peer_topics[socket]
+    try:
+      while 1:
+        message = socket.recv(zmq.NOBLOCK)
+        if message[:1] == '\x01':
+          topics.add(message[1:])
+        elif message[:1] == '\x00':
+          topics.discard(message[1:])
+    except zmq.ZMQError as e:
+      if e.errno != zmq.EAGAIN:
+        raise
+    return topic in topics
+
+  def __encode(self, event_name, event_args):
+    if self.wire_format:
+      return self.wire_format.encode(event_name, event_args)
+    return zlib.compress(pickle.dumps({'name': event_name, 'args': event_args}))
+
+  def __decode(self, event_data):
+    event = pickle.loads(zlib.decompress(event_data))
+    return event['name'], event['args']
+
+  def __dispatch(self, events, on_main_loop):
+    main_loop_handlers = []
+    for event_data in events:
+      try:
+        if wireformat.is_framed(event_data):
+          #skip the payload of events nobody is listening for
+          event_name = wireformat.peek(event_data)
+          if event_name not in self.__handlers:
+            continue
+          event_args = wireformat.decode(event_data)[1]
+        else:
+          event_name, event_args = self.__decode(event_data)
+      except Exception as e:
+        logging.error(format_exc())
+        continue
+      for handler in self.__take_handlers(event_name):
+        if handler[2] and handler[2]._finished:
+          continue
+        if handler[1] and not on_main_loop:
+          main_loop_handlers.append((handler[0], event_args))
+          continue
+        try:
+          handler[0](event_args)
+        except Exception as e:
+          logging.error(format_exc())
+    if main_loop_handlers:
+      IOLoop.instance().add_callback(lambda: self.__run_handlers(main_loop_handlers))
+
+  def __run_handlers(self, handlers):
+    for handler, event_args in handlers:
+      try:
+        handler(event_args)
+      except Exception as e:
+        logging.error(format_exc())
+
+  def __receive_batch(self, socket):
+    events = []
+    try:
+      while len(events) < self.batch_size:
+        #in subscription mode, the first frame is the topic
+        events.append(socket.recv_multipart(zmq.NOBLOCK)[-1])
+    except zmq.ZMQError as e:
+      if e.errno != zmq.EAGAIN:
+        raise
+    return events
+
+  def start_listening(self, threaded=False):
+    '''Starts listening for incoming events on ``EventManager.address``. Events are received on the main ``IOLoop``
+    unless ``threaded`` is ``True``, in which case events are received on a background thread and handlers registered
+    with ``run_on_main_loop=False`` will run on that thread.
+    '''
+    if self.__thread or self.__socket:
+      return
+    if threaded:
+      self.__thread = Thread(target=self.__receive_loop)
+      self.__thread.daemon = True
+      self.__thread.start()
       return
-    def receive():
-      context = zmq.Context()
-      socket = context.socket(zmq.PULL)
-      socket.bind(self.address)
-      while True:
-        event = pickle.loads(zlib.decompress(socket.recv()))
-        event_name = event['name']
-        event_args = event['args']
-        if event_name in self.__handlers:
-          handlers = self.__handlers[event_name]
-          for handler in list(handlers):
-            if not handler[3]:
-              handlers.remove(handler)
-            try:
-              if handler[2] and handler[2]._finished:
-                continue
-              if handler[1]:
-                (lambda h: IOLoop.instance().add_callback(lambda: h[0](event_args)))(handler)
-              else:
-                handler[0](event_args)
-            except Exception as e:
-              logging.error(format_exc())
-    self.__thread = Thread(target=receive)
-    self.__thread.daemon = True
-    self.__thread.start()
+    self.__socket = self.__bind_socket()
+    self.__update_subscriptions()
+    io_loop = IOLoop.instance()
+    def receive(fd=None, events=None):
+      if not self.__socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+        return
+      self.__dispatch(self.__receive_batch(self.__socket), True)
+      #the zmq file descriptor is edge triggered, so keep reading until the socket is empty
+      io_loop.add_callback(receive)
+    io_loop.add_handler(self.__socket.getsockopt(zmq.FD), receive, io_loop.READ)
+    io_loop.add_callback(receive)
+
+  def __receive_loop(self):
+    socket = self.__bind_socket()
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+    while True:
+      if self.__changed_subscriptions:
+        self.__update_subscriptions(socket)
+      if not poller.poll(self.routing == 'subscription' and 100 or None):
+        continue
+      try:
+        self.__dispatch(self.__receive_batch(socket), False)
+      except Exception as e:
+        logging.error(format_exc())
+
+  def __bind_socket(self):
+    socket = self.__zmq_context.socket(self.routing == 'subscription' and zmq.SUB or zmq.PULL)
+    socket.bind(self.address)
+    if self.routing == 'subscription':
+      with self.__handlers_lock:
+        self.__changed_subscriptions.update(self.__handlers)
+    return socket
   
   def send_to_server(self, address, event_name, event_args):
     '''Send a message with ``event_name`` and ``event_args`` only
@@ -115,27 +402,48 @@ class EventManager():
     efficient than ``send`` if you only intent to send the event
     to a single server and know the address in advance.
     '''
-    event = {'name': event_name, 'args': event_args}
-    event_data = zlib.compress(pickle.dumps(event))
-    self.__remote_servers[address].send(event_data)
+    event_data = self.__encode(event_name, event_args)
+    if self.routing == 'subscription':
+      socket = self.__remote_servers[address]
+      if not self.__subscribed(socket, _topic(event_name)):
+        logging.warning('Dropping event %s, the server at %s is not subscribed to it' % (event_name, address))
+        return
+      socket.send_multipart((_topic(event_name), event_data))
+    else:
+      self.__remote_servers[address].send(event_data)
   
   def send(self, event_name, event_args, broadcast=True):
     '''Send a message with ``event_name`` and ``event_args`` to
     all servers previously registered with ``register_server()``.
     If ``broadcast`` is false, the event will be sent to only
     a single server. Non-broadcast events are round-robin load
-    balanced between registered servers.
+    balanced between registered servers (with subscription routing,
+    only servers that are subscribed to ``event_name``).
     '''
     if not self.__remote_servers:
       return
-    event = {'name': event_name, 'args': event_args}
-    event_data = zlib.compress(pickle.dumps(event))
+    event_data = self.__encode(event_name, event_args)
+    message = self.routing == 'subscription' and (_topic(event_name), event_data) or None
     if not broadcast:
+      if message:
+        for i in xrange(len(self.__queued_servers)):
+          socket = self.__queued_servers[0]
+          self.__queued_servers.rotate(-1)
+          if self.__subscribed(socket, message[0]):
+            socket.send_multipart(message)
+            return
+        logging.warning('Dropping event %s, no servers are subscribed to it' % event_name)
+        return
       self.__queued_servers[0].send(event_data)
       self.__queued_servers.rotate(-1)
       return
     for socket in self.__queued_servers:
-      socket.send(event_data)
+      if message:
+        #the XPUB socket would filter the event anyway, checking keeps the peer's subscriptions up to date
+        if self.__subscribed(socket, message[0]):
+          socket.send_multipart(message)
+      else:
+        socket.send(event_data)
 
   @classmethod
   def instance(cls):
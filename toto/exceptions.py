@@ -9,6 +9,8 @@
   * ``ERROR_INVALID_SESSION_ID = 1007``
   * ``ERROR_INVALID_HMAC = 1008``
   * ``ERROR_INVALID_RESPONSE_HMAC = 1009``
+  * ``ERROR_TIMEOUT = 1010``
+  * ``ERROR_LIMIT_EXCEEDED = 1011``
 '''
 
 ERROR_SERVER = 1000
@@ -20,6 +22,8 @@ ERROR_USER_ID_EXISTS = 1006
 ERROR_INVALID_SESSION_ID = 1007
 ERROR_INVALID_HMAC = 1008
 ERROR_INVALID_RESPONSE_HMAC = 1009
+ERROR_TIMEOUT = 1010
+ERROR_LIMIT_EXCEEDED = 1011
 
 class TotoException(Exception):
   '''This class is used to return errors from Toto methods. ``TotoException.value``
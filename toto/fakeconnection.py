@@ -12,7 +12,7 @@ class FakeConnection(DBConnection):
   def create_session(self, user_id=None, password=None):
     return None
 
-  def retrieve_session(self, session_id, hmac_data=None, data=None):
+  def retrieve_session(self, session_id, hmac_data=None, data=None, account_fields=None):
     return None
 
   def remove_session(self, session_id):
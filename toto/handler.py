@@ -1,18 +1,22 @@
 from tornado.web import *
-import json
-import hashlib
-import hmac
 from invocation import *
 from exceptions import *
+from methodregistry import MethodRegistry, load_manifest
+from tasks import Future
+import serialization
+import signing
 from tornado.options import define, options
-import base64
 from tornado.httputil import parse_multipart_form_data
 import logging
 
 define("allow_origin", default="*", help="This is the value for the Access-Control-Allow-Origin header (default *)")
 define("method_select", default="both", metavar="both|url|parameter", help="Selects whether methods can be specified via URL, parameter in the message body or both (default both)")
-define("bson_enabled", default=False, help="Allows requests to use BSON with content-type application/bson")
-define("msgpack_enabled", default=False, help="Allows requests to use MessagePack with content-type application/msgpack")
+define("stream_chunk_size", default=65536, help="The number of bytes to buffer before flushing each chunk of a streaming response")
+define("batch_mode", default="serial", metavar="serial|concurrent", help="Selects whether the requests in a batch are invoked one at a time or concurrently (default serial)")
+define("batch_max_size", default=0, help="The maximum number of requests allowed in a single batch, or zero for no limit")
+define("batch_concurrency", default=0, help="In concurrent batch mode, the maximum number of requests from a single batch that may run at once, or zero for no limit")
+define("batch_timeout", default=30.0, help="In concurrent batch mode, the number of seconds to wait for all requests in a batch to complete before responding with timeout errors for the remaining requests, or zero to wait indefinitely")
+define("batch_threads", default=0, help="In concurrent batch mode, the number of threads to use for running synchronous methods in batches. If zero, synchronous methods run on the main thread")
 
 class TotoHandler(RequestHandler):
   '''The handler is responsible for processing all requests to the server. An instance
@@ -48,22 +52,29 @@ class TotoHandler(RequestHandler):
 
   SUPPORTED_METHODS = {"POST", "OPTIONS", "GET", "HEAD"}
   ACCESS_CONTROL_ALLOW_ORIGIN = options.allow_origin
+  #requests that have not finished, used to drain the server before it exits
+  active_requests = set()
 
   def initialize(self, db_connection):
     self.db_connection = db_connection
     self.db = self.db_connection.db
-    self.bson = options.bson_enabled and __import__('bson').BSON
-    self.msgpack = options.msgpack_enabled and __import__('msgpack')
     self.response_type = 'application/json'
     self.body = None
     self.registered_event_handlers = []
+    self.__registered_event_handler = False
     self.__active_methods = []
+    self.resolved_method = None
+    self.__response_stream = None
+    self.__prefetched_sessions = {}
+    self.__account_fields = None
     self.headers_only = False
+    TotoHandler.active_requests.add(self)
 
   @classmethod
   def configure(cls):
     """Runtime method configuration.
     """
+    serialization.configure()
     #Method configuration
     if options.event_mode != 'off':
       from toto.events import EventManager
@@ -71,15 +82,15 @@ class TotoHandler(RequestHandler):
     if options.method_select == 'url':
       def get_method_path(self, path, body):
         if path:
-          return path.split('/')
+          return path
         else:
           raise TotoException(ERROR_MISSING_METHOD, "Missing method.")
       cls.__get_method_path = get_method_path
     elif options.method_select == 'parameter':
       def get_method_path(self, path, body):
         if body and 'method' in body:
-          logging.info(body['method'])
-          return body['method'].split('.')
+          logging.debug(body['method'])
+          return body['method']
         else:
           raise TotoException(ERROR_MISSING_METHOD, "Missing method.")
       cls.__get_method_path = get_method_path
@@ -99,12 +110,60 @@ class TotoHandler(RequestHandler):
           headers = self.request.headers
           if not session_id:
             session_id = 'x-toto-session-id' in headers and headers['x-toto-session-id'] or get_cookie(self, 'toto-session-id')
-          if session_id:
-            self.session = self.db_connection.retrieve_session(session_id, 'x-toto-hmac' in headers and headers['x-toto-hmac'] or None, 'x-toto-hmac' in headers and self.request.body or None)
+          if session_id in self.__prefetched_sessions:
+            self.session = self.__prefetched_sessions.pop(session_id)
+          elif session_id:
+            self.session = self.db_connection.retrieve_session(session_id, 'x-toto-hmac' in headers and headers['x-toto-hmac'] or None, 'x-toto-hmac' in headers and self.request.body or None, self.__account_fields)
         if self.session:
           set_cookie(self, name='toto-session-id', value=self.session.session_id, expires_days=math.ceil(self.session.expires / (24.0 * 60.0 * 60.0)), domain=options.cookie_domain)
         return self.session
       cls.retrieve_session = retrieve_session
+
+      def request_session_id(self):
+        return self.request.headers.get('x-toto-session-id') or get_cookie(self, 'toto-session-id')
+      cls.__request_session_id = request_session_id
+    if options.batch_mode == 'concurrent':
+      from batch import BatchRequest
+      from tasks import TaskQueue
+      task_queue = None
+      if options.batch_threads > 0:
+        task_queue = TaskQueue.instance('toto.batch', options.batch_threads)
+      def batch_process_request(self, requests):
+        self.session = None
+        self.add_header('access-control-allow-origin', self.ACCESS_CONTROL_ALLOW_ORIGIN)
+        self.add_header('access-control-expose-headers', 'x-toto-hmac')
+        if options.batch_max_size and len(requests) > options.batch_max_size:
+          self.respond(error=TotoException(ERROR_LIMIT_EXCEEDED, "Batch size limit exceeded."))
+          return
+        BatchRequest(self, requests, options.batch_concurrency, options.batch_timeout, task_queue).start()
+      cls.batch_process_request = batch_process_request
+    #configure() runs again when the server reloads, so always wrap the original process_request
+    if '_base_process_request' not in vars(cls):
+      cls._base_process_request = cls.process_request.im_func
+    cls.process_request = cls._base_process_request
+    if options.db_async:
+      process_request = cls._base_process_request
+      def prefetch_session_process_request(self, path, request_body, parameters, finish_by_default=True):
+        try:
+          method = self.get_method(path, request_body)
+        except Exception as e:
+          method = None
+        if not (method and method.loads_session):
+          process_request(self, path, request_body, parameters, finish_by_default)
+          return
+        self.__account_fields = method.account_fields
+        def resume(future):
+          if self._finished:
+            return
+          if future.exception():
+            self.session = None
+            self.add_header('access-control-allow-origin', self.ACCESS_CONTROL_ALLOW_ORIGIN)
+            self.add_header('access-control-expose-headers', 'x-toto-hmac')
+            self.respond(error=future.exception())
+          else:
+            process_request(self, path, request_body, parameters, finish_by_default)
+        self.retrieve_session_async(method.loads_session == 'parameter' and parameters.get('session_id') or None).add_done_callback(resume)
+      cls.process_request = prefetch_session_process_request
     if options.debug:
       import traceback
       def error_info(self, e):
@@ -116,25 +175,34 @@ class TotoHandler(RequestHandler):
           return TotoException(ERROR_SERVER, str(e)).__dict__
       cls.error_info = error_info
     cls.__method_root = __import__(options.method_module)
-      
+    #with autoreload, modules may be replaced at any time so only resolve methods as they are requested
+    cls.method_registry = MethodRegistry(cls.__method_root, lazy=options.autoreload, manifest=options.method_manifest and load_manifest(options.method_manifest) or None)
+    if options.autoreload and not getattr(cls, '_reload_hook_added', False):
+      import tornado.autoreload
+      tornado.autoreload.add_reload_hook(lambda: cls.method_registry.clear())
+      cls._reload_hook_added = True
+
   def __get_method_path(self, path, body):
     """The default method_select "both" (or any unsupported value) will
     call this method. The class method ``configure()`` will update this
     to a more efficient method according to ``tornado.options``.
     """
     if path:
-      return path.split('/')
+      return path
     elif body and 'method' in body:
-      logging.info(body['method'])
-      return body['method'].split('.')
+      logging.debug(body['method'])
+      return body['method']
     else:
       raise TotoException(ERROR_MISSING_METHOD, "Missing method.")
 
-  def __get_method(self, path):
-    method = self.__method_root
-    for i in path:
-      method = getattr(method, i)
-    return method
+  def __get_method(self, name):
+    return self.method_registry.resolve(name)
+
+  def get_method(self, path, request_body):
+    '''Returns the ``toto.methodregistry.ResolvedMethod`` that will be invoked for a request with
+    the given ``path`` and ``request_body``.
+    '''
+    return self.__get_method(self.__get_method_path(path, request_body))
 
   def error_info(self, e):
     if isinstance(e, TotoException):
@@ -145,17 +213,20 @@ class TotoHandler(RequestHandler):
       logging.error("TotoException: %s Value: %s" % (e.code, e.value))
       return e.__dict__
 
-  def invoke_method(self, path, request_body, parameters, finish_by_default=True):
+  def invoke_method(self, path, request_body, parameters, finish_by_default=True, handler=None):
     result = None
     error = None
     method = None
     try:
       method = self.__get_method(self.__get_method_path(path, request_body))
       self.__active_methods.append(method)
-      result = method.invoke(self, parameters)
+      self.__account_fields = method.account_fields
+      handler = handler or self
+      handler.resolved_method = method
+      result = method.invoke(handler, parameters)
     except Exception as e:
       error = self.error_info(e)
-    return result, error, (finish_by_default and not hasattr(method, 'asynchronous'))
+    return result, error, (finish_by_default and not (method and method.asynchronous))
 
   def options(self, path=None):
     allowed_headers = set(['x-toto-hmac','x-toto-session-id','origin','content-type'])
@@ -187,19 +258,15 @@ class TotoHandler(RequestHandler):
   @tornado.web.asynchronous
   def post(self, path=None):
     content_type = 'content-type' in self.request.headers and self.request.headers['content-type'] or 'application/json'
-    if not content_type.startswith('application/json'):
-      if content_type.startswith('application/x-www-form-urlencoded'):
-        self.body = {'parameters': self.request.arguments}
-      elif content_type.startswith('multipart/form-data'):
-        self.body = {'parameters': {'arguments': self.request.arguments, 'files': self.request.files}}
-      elif self.bson and content_type.startswith('application/bson'):
-        self.response_type = 'application/bson'
-        self.body = self.bson(self.request.body).decode()
-      elif self.msgpack and content_type.startswith('application/msgpack'):
-        self.response_type = 'application/msgpack'
-        self.body = self.msgpack.loads(self.request.body)
+    if content_type.startswith('application/x-www-form-urlencoded'):
+      self.body = {'parameters': self.request.arguments}
+    elif content_type.startswith('multipart/form-data'):
+      self.body = {'parameters': {'arguments': self.request.arguments, 'files': self.request.files}}
     else:
-      self.body = json.loads(self.request.body)
+      codec = serialization.codec(content_type)
+      if codec:
+        self.response_type = codec.content_type
+        self.body = codec.loads(self.request.body)
     if self.body and 'batch' in self.body:
       self.batch_process_request(self.body['batch'])
     else:
@@ -209,19 +276,21 @@ class TotoHandler(RequestHandler):
     self.session = None
     self.add_header('access-control-allow-origin', self.ACCESS_CONTROL_ALLOW_ORIGIN)
     self.add_header('access-control-expose-headers', 'x-toto-hmac')
-    request_keys = sorted(requests.keys())
-    batch_results = {}
-    for k, v in ((i, requests[i]) for i in request_keys):
-      (result, error, finish_by_default) = self.invoke_method(None, v, v['parameters'], False)
-      batch_results[k] = error is not None and {'error': isinstance(error, dict) and error or self.error_info(error)} or {'result': result}
-    self.respond(batch_results=batch_results)
+    if options.batch_max_size and len(requests) > options.batch_max_size:
+      self.respond(error=TotoException(ERROR_LIMIT_EXCEEDED, "Batch size limit exceeded."))
+      return
+    #run one request at a time so asynchronous and @cpu_bound results are resolved before the batch responds
+    from batch import BatchRequest
+    BatchRequest(self, requests, 1).start()
 
   def process_request(self, path, request_body, parameters, finish_by_default=True):
     self.session = None
     self.add_header('access-control-allow-origin', self.ACCESS_CONTROL_ALLOW_ORIGIN)
     self.add_header('access-control-expose-headers', 'x-toto-hmac')
     (result, error, finish_by_default) = self.invoke_method(path, request_body, parameters, finish_by_default)
-    if result is not None or error:
+    if isinstance(result, Future):
+      self.respond_future(result)
+    elif result is not None or error:
       self.respond(result, error)
     elif finish_by_default and not self._finished:
       self.finish()
@@ -229,11 +298,11 @@ class TotoHandler(RequestHandler):
   def respond(self, result=None, error=None, batch_results=None):
     '''Respond to the request with the given result or error object (the ``batch_results`` parameter
     is for internal use only and not intendented to be supplied manually). Responses will be
-    serialized according to the ``response_type`` propery. The default serialization is
-    "application/json". Other supported protocols are:
+    serialized with the ``toto.serialization`` codec registered for the ``response_type`` property, falling back
+    to JSON. The default serialization is "application/json". Other built in protocols are:
 
-    * application/bson - requires pymongo
-    * application/msgpack - requires msgpack-python
+    * application/bson - requires pymongo and ``--bson_enabled``
+    * application/msgpack - requires msgpack-python and ``--msgpack_enabled``
 
     The response will also contain any available session information.
     
@@ -257,16 +326,24 @@ class TotoHandler(RequestHandler):
       response['batch'] = batch_results
     if self.session:
       response['session'] = {'session_id': self.session.session_id, 'expires': self.session.expires, 'user_id': str(self.session.user_id)}
-    if self.response_type == 'application/bson':
-      response_body = str(self.bson.encode(response))
-    elif self.response_type == 'application/msgpack':
-      response_body = self.msgpack.dumps(response)
-    else:
-      response_body = json.dumps(response)
+    response_body = (serialization.codec(self.response_type) or serialization.JSON).dumps(response)
     if self.session:
-      self.add_header('x-toto-hmac', base64.b64encode(hmac.new(str(self.session.user_id).lower(), response_body, hashlib.sha1).digest()))
+      self.add_header('x-toto-hmac', signing.sign(str(self.session.user_id).lower(), response_body))
     self.respond_raw(response_body, self.response_type)
 
+  def respond_future(self, future):
+    '''Respond with the result of the ``toto.tasks.Future`` ``future`` (or its exception) once it is done.
+    Methods may also return a future instead of calling this directly.
+    '''
+    def respond(future):
+      try:
+        result = future.result()
+      except Exception as e:
+        self.respond(error=e)
+        return
+      self.respond(result)
+    future.add_done_callback(respond)
+
   def respond_raw(self, body, content_type, finish=True):
     '''Respond raw is used by respond to send the response to the client. You can pass a string as the body parameter
     and it will be written directly to the response stream. The response "content-type" header will be set to ``content_type``.
@@ -279,6 +356,128 @@ class TotoHandler(RequestHandler):
     if finish:
       self.finish()
 
+  def respond_stream(self, iterable, raw=False):
+    '''Send the items produced by ``iterable`` to the client as they become available. Each item is serialized
+    with the codec for ``response_type`` (framed as a JSON array for JSON responses) and written with chunked
+    transfer encoding. Items are buffered until ``--stream_chunk_size`` bytes are ready, then the next chunk is
+    only prepared once the previous one has been written to the client. If ``raw`` is ``True``, items must be
+    strings and are written without serialization. The response is finished when ``iterable`` is exhausted.
+
+    ``iterable`` may also be an asynchronous stream with a ``next_future()`` method, like the
+    ``toto.workerconnection.WorkerStream`` returned by ``WorkerConnection.invoke_stream()``. Each call to
+    ``next_future()`` must return a ``toto.tasks.Future`` for the next item that fails with ``StopIteration``
+    at the end of the stream. Items are written as they arrive.
+    '''
+    self.add_header('content-type', self.response_type)
+    if self.headers_only:
+      self.finish()
+      return
+    codec = not raw and (serialization.codec(self.response_type) or serialization.JSON) or None
+    if hasattr(iterable, 'next_future'):
+      self.__respond_async_stream(iterable, codec)
+      return
+    iterator = iter(iterable)
+    self.__response_stream = iterator
+    chunk_size = options.stream_chunk_size
+    state = {'started': False, 'flushed': False}
+    def write_chunk():
+      if self._finished:
+        return
+      chunk = []
+      size = 0
+      finished = False
+      try:
+        if not state['started']:
+          chunk.append(codec and codec.stream_prefix or '')
+        for item in iterator:
+          if codec:
+            item = codec.dumps(item)
+            if state['started']:
+              chunk.append(codec.stream_separator)
+          state['started'] = True
+          chunk.append(item)
+          size += len(item)
+          if size >= chunk_size:
+            break
+        else:
+          finished = True
+          if codec:
+            chunk.append(codec.stream_suffix)
+      except Exception as e:
+        self.__close_response_stream()
+        if not state['flushed']:
+          self.respond(error=e)
+        else:
+          self.error_info(e)
+          self.finish()
+        return
+      self.write(''.join(chunk))
+      if finished:
+        self.__response_stream = None
+        self.finish()
+      else:
+        state['flushed'] = True
+        self.flush(callback=write_chunk)
+    write_chunk()
+
+  def __respond_async_stream(self, stream, codec):
+    self.__response_stream = stream
+    chunk_size = options.stream_chunk_size
+    state = {'started': False, 'flushed': False}
+    def write_chunk(future=None):
+      if self._finished:
+        return
+      chunk = []
+      size = 0
+      if not state['started']:
+        chunk.append(codec and codec.stream_prefix or '')
+      while 1:
+        pending = future or stream.next_future()
+        future = None
+        if not pending.done():
+          #send what is ready and wait for the next item, the prefix is held back until there is an item to follow it
+          if size:
+            self.write(''.join(chunk))
+            state['flushed'] = True
+            self.flush()
+          pending.add_done_callback(write_chunk)
+          return
+        try:
+          item = pending.result()
+        except StopIteration:
+          if codec:
+            chunk.append(codec.stream_suffix)
+          self.write(''.join(chunk))
+          self.__response_stream = None
+          self.finish()
+          return
+        except Exception as e:
+          self.__close_response_stream()
+          if not state['flushed']:
+            self.respond(error=e)
+          else:
+            self.error_info(e)
+            self.finish()
+          return
+        if codec:
+          item = codec.dumps(item)
+          if state['started']:
+            chunk.append(codec.stream_separator)
+        state['started'] = True
+        chunk.append(item)
+        size += len(item)
+        if size >= chunk_size:
+          self.write(''.join(chunk))
+          state['flushed'] = True
+          self.flush(callback=write_chunk)
+          return
+    write_chunk()
+
+  def __close_response_stream(self):
+    if self.__response_stream and hasattr(self.__response_stream, 'close'):
+      self.__response_stream.close()
+    self.__response_stream = None
+
   def on_connection_close(self):
     '''You should not call this method directly, but if you implement an ``on_connection_close()`` function in a
     method module (where you defined invoke) it will be called when the connection closes if that method was
@@ -290,21 +489,32 @@ class TotoHandler(RequestHandler):
       def on_connection_close(handler):
         #clean up
     '''
+    self.__close_response_stream()
     for method in self.__active_methods:
-      if hasattr(method, 'on_connection_close'):
+      if method.on_connection_close:
         method.on_connection_close(self);
     self.on_finish()
 
-  def register_event_handler(self, event_name, handler, run_on_main_loop=True, deregister_on_finish=False):
+  def register_event_handler(self, event_name, handler, run_on_main_loop=True, deregister_on_finish=False, coalesce=None, window=0, max_batch=0):
     '''If using Toto's event framework, this method makes it easy to register an event callback tied to the
     current connection and handler. Event handlers registered via this method will not be called once this handler
     has finished (connection closed). The ``deregister_on_finish`` parameter will cause this handler to be explicitly
     deregisted as part of the ``handler.on_finish`` event. Otherwise, event handlers are only cleaned up when the
     associated event is received.
 
+    Use ``coalesce``, ``window`` and ``max_batch`` to receive bursts of events in a single call, e.g. to update
+    a presence indicator at most once per second::
+
+      handler.register_event_handler('presence', on_presence, coalesce='latest', window=1.0)
+
+    See ``EventManager.register_handler()`` for details.
+
+    All event handlers registered with this method are removed when the request finishes.
+
     The return value can be used to manually deregister the event handler at a later point.
     '''
-    sig = TotoHandler.event_manager.instance().register_handler(event_name, handler, run_on_main_loop, self)
+    sig = TotoHandler.event_manager.instance().register_handler(event_name, handler, run_on_main_loop, self, coalesce=coalesce, window=window, max_batch=max_batch)
+    self.__registered_event_handler = True
     if deregister_on_finish:
       self.registered_event_handlers.append(sig)
     return sig
@@ -333,11 +543,39 @@ class TotoHandler(RequestHandler):
       headers = self.request.headers
       if not session_id and 'x-toto-session-id' in headers:
         session_id = 'x-toto-session-id' in headers and headers['x-toto-session-id'] or None
-      if session_id:
-        self.session = self.db_connection.retrieve_session(session_id, 'x-toto-hmac' in headers and headers['x-toto-hmac'] or None, self.request.body)
+      if session_id in self.__prefetched_sessions:
+        self.session = self.__prefetched_sessions.pop(session_id)
+      elif session_id:
+        self.session = self.db_connection.retrieve_session(session_id, 'x-toto-hmac' in headers and headers['x-toto-hmac'] or None, self.request.body, self.__account_fields)
     return self.session
+
+  def __request_session_id(self):
+    return self.request.headers.get('x-toto-session-id')
+
+  def retrieve_session_async(self, session_id=None):
+    '''Load the session specified by the request headers (or if enabled, the request cookie), or the session matching
+    ``session_id``, with ``db_connection.retrieve_session_async()``. Returns a ``toto.tasks.Future`` that resolves to
+    the session, or ``None`` if there is no session. Once the future is done, the next call to ``retrieve_session()``
+    with the same session ID will use the loaded session instead of querying the database.
+    '''
+    session_id = session_id or self.__request_session_id()
+    if not session_id:
+      future = Future()
+      future.set_result(None)
+      return future
+    headers = self.request.headers
+    hmac_data = 'x-toto-hmac' in headers and headers['x-toto-hmac'] or None
+    future = self.db_connection.retrieve_session_async(session_id, hmac_data, (hmac_data or not options.use_cookies) and self.request.body or None, self.__account_fields)
+    def store_session(future):
+      if not future.exception():
+        self.__prefetched_sessions[session_id] = future.result()
+    future.add_done_callback(store_session)
+    return future
     
   def on_finish(self):
-    while self.registered_event_handlers:
-      self.deregister_event_handler(self.registered_event_handlers[0])
+    TotoHandler.active_requests.discard(self)
+    if self.__registered_event_handler:
+      self.__registered_event_handler = False
+      del self.registered_event_handlers[:]
+      TotoHandler.event_manager.instance().remove_request_handler(self)
 
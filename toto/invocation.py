@@ -1,18 +1,23 @@
 '''``toto.invocation`` contains many decorators that may be applied to the ``invoke(handler, parameters)`` functions in
   method modules in order to modify their behavior.
+
+  When the server is run with ``--db_async``, the session used by the ``@authenticated`` family of decorators is
+  loaded on the database connection's thread pool before the decorated function is invoked, so the ``IOLoop`` is
+  not blocked while the session is retrieved.
 '''
 
 from exceptions import *
 from tornado.options import options
 from traceback import format_exc
 import logging
-import json
+import serialization
+from cpupool import CPUPool
 
 """
 This is a list of all attributes that may be added by a decorator,
 it is used to allow decorators to be order agnostic.
 """
-invocation_attributes = ['asynchronous', '__doc__', '__repr__']
+invocation_attributes = ['asynchronous', 'streaming', 'cpu_bound', 'loads_session', 'account_fields', '__doc__', '__repr__']
 
 def __copy_attributes(fn, wrapper):
   for a in invocation_attributes:
@@ -41,6 +46,7 @@ def anonymous_session(fn):
       handler.create_session()
     return fn(handler, parameters)
   __copy_attributes(fn, wrapper)
+  wrapper.loads_session = True
   return wrapper
 
 def authenticated(fn):
@@ -55,6 +61,7 @@ def authenticated(fn):
       raise TotoException(ERROR_NOT_AUTHORIZED, "Not authorized")
     return fn(handler, parameters)
   __copy_attributes(fn, wrapper)
+  wrapper.loads_session = True
   return wrapper
 
 def optionally_authenticated(fn):
@@ -66,6 +73,7 @@ def optionally_authenticated(fn):
     handler.retrieve_session()
     return fn(handler, parameters)
   __copy_attributes(fn, wrapper)
+  wrapper.loads_session = True
   return wrapper
 
 def authenticated_with_parameter(fn):
@@ -81,8 +89,25 @@ def authenticated_with_parameter(fn):
       raise TotoException(ERROR_NOT_AUTHORIZED, "Not authorized")
     return fn(handler, parameters)
   __copy_attributes(fn, wrapper)
+  wrapper.loads_session = 'parameter'
   return wrapper
 
+def prefetch_account(*args):
+  '''Invoke functions marked with the ``@prefetch_account`` decorator will load the listed account properties
+  together with the session, so reading them from ``handler.session.get_account()`` does not require further
+  queries. Use this with ``@authenticated`` or one of the other session decorators::
+
+    @authenticated
+    @prefetch_account('email', 'display_name')
+    def invoke(handler, parameters):
+      account = handler.session.get_account()
+      return {'email': account['email'], 'display_name': account['display_name']}
+  '''
+  def decorator(fn):
+    fn.account_fields = args
+    return fn
+  return decorator
+
 def requires(*args):
   '''Invoke functions marked with the ``@requires`` decorator will error if any of the parameters
   passed to the decorator are missing. The following example will error if either "param1" or "param2"
@@ -116,6 +141,62 @@ def raw_response(fn):
   __copy_attributes(fn, wrapper)
   return wrapper
 
+def cpu_bound(fn):
+  '''Invoke functions marked with the ``@cpu_bound`` decorator run in the process pool started with
+  ``--cpu_pool_processes`` so they don't block the ``IOLoop``. The request handler responds with the function's
+  return value once it is available. The function is called with ``None`` in place of the handler, so it can only
+  use its parameters, and both the parameters and the return value must be picklable::
+
+    @cpu_bound
+    def invoke(handler, parameters):
+      return {'thumbnail': resize(parameters['image'], 128, 128)}
+
+  Decorators that need the handler, like ``@authenticated``, are applied in the server process as usual. Without
+  a pool, the function runs on the ``IOLoop`` thread. Decorators below ``@cpu_bound`` run in the pool with the
+  function, so they must not use the handler.
+  '''
+  def wrapper(handler, parameters):
+    #the pool finds the function through the invoke function of the method module being invoked
+    handler.respond_future(CPUPool.run(fn, parameters, handler.resolved_method.module.__name__))
+    return None
+  __copy_attributes(fn, wrapper)
+  wrapper.asynchronous = True
+  wrapper.cpu_bound = fn
+  return wrapper
+
+def streaming(fn=None, raw=False):
+  '''Invoke functions marked with the ``@streaming`` decorator may return a generator (or any other iterable).
+  Items will be serialized and sent to the client as they are produced using chunked transfer encoding, so
+  large results never need to be held in memory. With JSON, the response is a JSON array of the items. Other
+  codecs write the serialized items one after another (e.g. a stream of msgpack objects). Pass ``raw=True`` to
+  write each item directly to the response stream, like ``@raw_response``::
+
+    @streaming
+    def invoke(handler, parameters):
+      for row in handler.db.query('select * from log'):
+        yield row
+
+  The handler waits for each chunk to be written to the client before requesting more items from the
+  iterable. Streamed responses are not signed with the ``x-toto-hmac`` header and streaming methods can't be
+  called in a batch.
+
+  Invoke functions may also return the ``WorkerStream`` from ``WorkerConnection.invoke_stream()`` to forward
+  results from a worker as they are produced.
+  '''
+  def decorator(fn):
+    def wrapper(handler, parameters):
+      if raw:
+        handler.response_type = 'application/octet-stream'
+      handler.respond_stream(fn(handler, parameters), raw)
+      return None
+    __copy_attributes(fn, wrapper)
+    wrapper.asynchronous = True
+    wrapper.streaming = True
+    return wrapper
+  if fn is None:
+    return decorator
+  return decorator(fn)
+
 def jsonp(callback_name='jsonp'):
   '''Invoke functions marked with the ``@jsonp`` decorator will return a wrapper response that will
   call a client-side javascript function. This decorator requires a "jsonp" parameter set to the name of the javascript
@@ -141,7 +222,7 @@ def jsonp(callback_name='jsonp'):
       callback = parameters.get(callback_name, None)
       if callback:
         del parameters[callback_name]
-        handler.respond_raw('%s(%s)' % (callback, json.dumps(fn(handler, parameters))), 'text/javascript')
+        handler.respond_raw('%s(%s)' % (callback, serialization.JSON.dumps(fn(handler, parameters))), 'text/javascript')
         return None
       else:
         return fn(handler, parameters)
@@ -0,0 +1,143 @@
+'''``MethodRegistry`` resolves Toto method names (``a.b.c``) and URL paths (``a/b/c``) to the method modules
+that implement them. Lookups are cached so each method is only resolved once per process, and names that do
+not map to a module with an ``invoke`` function are rejected without touching the import system.
+
+A method manifest is a JSON object mapping method names to the modules that implement them. With a manifest
+(see ``--method_manifest``), a method's module is only imported the first time the method is resolved, so a
+method package that doesn't import its submodules in ``__init__.py`` can start without importing any of them.
+Create one with ``build_manifest()``::
+
+  save_manifest(build_manifest(__import__('methods')), 'methods.json')
+'''
+
+import sys
+import json
+import pkgutil
+from types import ModuleType
+from invocation import invocation_attributes
+from exceptions import *
+
+class ResolvedMethod(object):
+  '''A resolved method. ``invoke`` is the method module's (decorated) invoke function and ``module`` is the
+  module it was loaded from. Any attributes in ``toto.invocation.invocation_attributes`` that were set by
+  decorators (e.g. ``asynchronous``) are copied to the instance, defaulting to ``None``.
+  '''
+
+  def __init__(self, name, module):
+    self.name = name
+    self.module = module
+    self.invoke = module.invoke
+    self.on_connection_close = getattr(module, 'on_connection_close', None)
+    for a in invocation_attributes:
+      if not a.startswith('__'):
+        setattr(self, a, getattr(self.invoke, a, None))
+
+  def __repr__(self):
+    return '<ResolvedMethod %s (%s)>' % (self.name, self.module.__name__)
+
+class MethodRegistry(object):
+  '''Maps method names to ``ResolvedMethod`` instances for the package ``root``. Unless ``lazy`` is ``True``,
+  all method modules in ``root`` (and any method modules it imports under another name) are registered
+  immediately. Other names are resolved on first use by walking the attributes of ``root`` and cached
+  if they lead to a method module.
+
+  If ``manifest`` (a dictionary mapping method names to module names) is passed, nothing is registered
+  up front and methods in the manifest are imported from their modules on first use.
+  '''
+
+  def __init__(self, root, lazy=False, manifest=None):
+    self.root = root
+    self.manifest = manifest
+    self.__methods = {}
+    if not lazy and manifest is None:
+      self.load()
+
+  def load(self):
+    '''Register every method module that can be reached from ``root`` through its own package tree.'''
+    seen = set()
+    def walk(module, path):
+      if id(module) in seen:
+        return
+      seen.add(id(module))
+      if path and callable(getattr(module, 'invoke', None)):
+        self.register(path, module)
+      for name, value in vars(module).items():
+        if name.startswith('_') or not isinstance(value, ModuleType):
+          continue
+        if value.__name__.startswith(module.__name__ + '.') or hasattr(value, 'invoke'):
+          walk(value, path + [name])
+    walk(self.root, [])
+
+  def register(self, path, module):
+    '''Register ``module`` under both the dotted and URL forms of ``path`` (a list of name segments).'''
+    method = ResolvedMethod('.'.join(path), module)
+    self.__methods[method.name] = method
+    self.__methods['/'.join(path)] = method
+    return method
+
+  def clear(self):
+    '''Drop all cached lookups, e.g. after modules have been reloaded.'''
+    self.__methods.clear()
+
+  def resolve(self, name):
+    '''Return the ``ResolvedMethod`` for ``name``, where ``name`` is either a dotted method name or
+    a URL path. Raises ``TotoException`` with ``ERROR_MISSING_METHOD`` if no such method exists.
+    '''
+    try:
+      return self.__methods[name]
+    except KeyError:
+      pass
+    path = name.replace('/', '.').split('.')
+    module_name = self.manifest and self.manifest.get('.'.join(path))
+    if module_name:
+      __import__(module_name)
+      return self.register(path, sys.modules[module_name])
+    module = self.root
+    for segment in path:
+      if not segment or segment.startswith('_'):
+        module = None
+        break
+      module = getattr(module, segment, None)
+      if not isinstance(module, ModuleType):
+        break
+    if not isinstance(module, ModuleType) or not callable(getattr(module, 'invoke', None)):
+      raise TotoException(ERROR_MISSING_METHOD, "Missing method: %s" % name)
+    return self.register(path, module)
+
+  def __getitem__(self, name):
+    return self.resolve(name)
+
+  def __contains__(self, name):
+    try:
+      self.resolve(name)
+      return True
+    except TotoException:
+      return False
+
+  def __len__(self):
+    return len(self.__methods)
+
+  def names(self):
+    '''Returns the dotted names of all currently registered methods.'''
+    return sorted({m.name for m in self.__methods.itervalues()})
+
+  def to_manifest(self):
+    '''Returns a manifest of all currently registered methods.'''
+    return {m.name: m.module.__name__ for m in self.__methods.itervalues()}
+
+def build_manifest(root):
+  '''Import every module in the package ``root`` and return a manifest of the methods that can be reached from it.'''
+  if hasattr(root, '__path__'):
+    for loader, name, is_package in pkgutil.walk_packages(root.__path__, root.__name__ + '.'):
+      __import__(name)
+  return MethodRegistry(root).to_manifest()
+
+def load_manifest(path):
+  '''Returns the manifest stored in the JSON file at ``path``.'''
+  with open(path, 'rb') as f:
+    return json.load(f)
+
+def save_manifest(manifest, path):
+  '''Write ``manifest`` to ``path`` as JSON.'''
+  with open(path, 'wb') as f:
+    json.dump(manifest, f, indent=2, sort_keys=True)
@@ -14,6 +14,6 @@ def invoke(handler, params):
   for k in params:
     account[k] = params[k]
     result['updated_fields'].append(k)
-    account.save()
+  account.save()
   return result
   
@@ -5,10 +5,9 @@ from time import time
 from datetime import datetime
 import base64
 import uuid
-import hmac
-import hashlib
 import cPickle as pickle
 import toto.secret as secret
+import toto.signing as signing
 from dbconnection import DBConnection
 
 class MongoDBSession(TotoSession):
@@ -79,20 +78,28 @@ class MongoDBConnection(DBConnection):
     session._verified = True
     return session
 
-  def retrieve_session(self, session_id, hmac_data=None, data=None):
+  def retrieve_session(self, session_id, hmac_data=None, data=None, account_fields=None):
     session_data = self.db.sessions.find_one({'session_id': session_id, 'expires': {'$gt': time()}})
     if not session_data:
       return None
     user_id = session_data['user_id']
     if session_data['expires'] < (time() + (user_id and self.session_renew or self.anon_session_renew)):
       session_data['expires'] = time() + (user_id and self.session_ttl or self.anon_session_ttl)
-      self.db.sesions.update({'session_id': session_id}, {'$set': {'expires': session_data['expires']}})
+      if self._session_renewer is not None:
+        self._session_renewer.renew(session_id, bool(user_id))
+      else:
+        self.db.sessions.update({'session_id': session_id}, {'$set': {'expires': session_data['expires']}})
     session = MongoDBSession(self.db, session_data)
-    if data and hmac_data != base64.b64encode(hmac.new(str(user_id), data, hashlib.sha1).digest()):
+    if user_id and account_fields:
+      session.get_account()._set_loaded_properties(account_fields, self.db.accounts.find_one({'user_id': user_id}, {a: 1 for a in account_fields}))
+    if data and not signing.verify(str(user_id), data, hmac_data):
       raise TotoException(ERROR_INVALID_HMAC, "Invalid HMAC")
     session._verified = True
     return session
 
+  def _renew_sessions(self, session_ids, ttl):
+    self.db.sessions.update({'session_id': {'$in': list(session_ids)}}, {'$set': {'expires': time() + ttl}}, multi=True)
+
   def remove_session(self, session_id):
     self.db.sessions.remove({'session_id': session_id})
 
@@ -6,10 +6,9 @@ from datetime import datetime
 from dbconnection import DBConnection
 from uuid import uuid4
 import toto.secret as secret
+import toto.signing as signing
 import base64
 import uuid
-import hmac
-import hashlib
 import random
 import string
 import cPickle as pickle
@@ -52,6 +51,8 @@ class MySQLdbSession(TotoSession):
     self._db.execute("update session set state = %s where session_id = %s", pickle.dumps(self.state), self.session_id)
 
 class MySQLdbConnection(DBConnection):
+  #tornado.database.Connection wraps a single MySQLdb connection which must not be shared between threads
+  async_thread_limit = 1
 
   def create_tables(self, database):
     if not self.db.get('''show tables like "account"'''):
@@ -110,20 +111,29 @@ class MySQLdbConnection(DBConnection):
     session._verified = True
     return session
 
-  def retrieve_session(self, session_id, hmac_data=None, data=None):
-    session_data = self.db.get("select session.session_id, session.expires, session.state, account.user_id, account.account_id from session join account on account.account_id = session.account_id where session.session_id = %s and session.expires > %s", session_id, time())
+  def retrieve_session(self, session_id, hmac_data=None, data=None, account_fields=None):
+    account_columns = account_fields and ''.join([', account.%s as _account_%s' % (f, f) for f in account_fields]) or ''
+    session_data = self.db.get("select session.session_id, session.expires, session.state, account.user_id, account.account_id" + account_columns + " from session join account on account.account_id = session.account_id where session.session_id = %s and session.expires > %s", session_id, time())
     if not session_data:
       return None
     user_id = session_data['user_id']
     if session_data['expires'] < (time() + (user_id and self.session_renew or self.anon_session_renew)):
       session_data['expires'] = time() + (user_id and self.session_ttl or self.anon_session_ttl)
-      self.db.execute("update session set expires = %s where session_id = %s", session_data['expires'], session_id)
+      if self._session_renewer is not None:
+        self._session_renewer.renew(session_id, bool(user_id))
+      else:
+        self.db.execute("update session set expires = %s where session_id = %s", session_data['expires'], session_id)
     session = MySQLdbSession(self.db, session_data)
-    if data and hmac_data != base64.b64encode(hmac.new(str(user_id), data, hashlib.sha1).digest()):
+    if account_fields:
+      session.get_account()._set_loaded_properties(account_fields, dict((f, session_data['_account_' + f]) for f in account_fields))
+    if data and not signing.verify(str(user_id), data, hmac_data):
       raise TotoException(ERROR_INVALID_HMAC, "Invalid HMAC")
     session._verified = True
     return session
 
+  def _renew_sessions(self, session_ids, ttl):
+    self.db.execute("update session set expires = %s where session_id in (" + ','.join(['%s' for i in session_ids]) + ")", time() + ttl, *session_ids)
+
   def remove_session(self, session_id):
     self.db.execute("delete from session where session_id = %s", session_id)
 
@@ -5,11 +5,10 @@ from datetime import datetime
 from psycopg2.pool import ThreadedConnectionPool
 from itertools import izip
 import toto.secret as secret
+import toto.signing as signing
 import cPickle as pickle
 import base64
 import uuid
-import hmac
-import hashlib
 import random
 import string
 from dbconnection import DBConnection
@@ -52,7 +51,7 @@ class PostgresSession(TotoSession):
       self._properties['account_id'] = session.account_id
 
     def _load_property(self, *args):
-      return self._session._db.get('select ' + ', '.join(args) + ' from account where account_id = %s', (self._session.account_id))
+      return self._session._db.get('select ' + ', '.join(args) + ' from account where account_id = %s', (self._session.account_id,))
 
     def _save_property(self, *args):
       self._session._db.execute('update account set ' + ', '.join(['%s = %%s' % k for k in args]) + ' where account_id = %s', ([self[k] for k in args] + [self._session.account_id,]))
@@ -100,6 +99,7 @@ class PostgresConnection(DBConnection):
 
   def __init__(self, host, port, database, username, password, session_ttl=24*60*60*365, anon_session_ttl=24*60*60, session_renew=0, anon_session_renew=0, min_connections=1, max_connections=10):
     self.db = ThreadedConnectionPool(min_connections, max_connections, database=database, user=username, password=password, host=host, port=port)
+    self.async_thread_limit = max_connections
     self.create_tables()
     self.session_ttl = session_ttl
     self.anon_session_ttl = anon_session_ttl or self.session_ttl
@@ -130,20 +130,29 @@ class PostgresConnection(DBConnection):
     session._verified = True
     return session
 
-  def retrieve_session(self, session_id, hmac_data=None, data=None):
-    session_data = self.db.get("select session.session_id, session.expires, session.state, account.user_id, account.account_id from session join account on account.account_id = session.account_id where session.session_id = %s and session.expires > %s", (session_id, time()))
+  def retrieve_session(self, session_id, hmac_data=None, data=None, account_fields=None):
+    account_columns = account_fields and ''.join([', account.%s as _account_%s' % (f, f) for f in account_fields]) or ''
+    session_data = self.db.get("select session.session_id, session.expires, session.state, account.user_id, account.account_id" + account_columns + " from session join account on account.account_id = session.account_id where session.session_id = %s and session.expires > %s", (session_id, time()))
     if not session_data:
       return None
     user_id = session_data['user_id']
     if session_data['expires'] < (time() + (user_id and self.session_renew or self.anon_session_renew)):
       session_data['expires'] = time() + (user_id and self.session_ttl or self.anon_session_ttl)
-      self.db.execute("update session set expires = %s where session_id = %s", (session_data['expires'], session_id))
+      if self._session_renewer is not None:
+        self._session_renewer.renew(session_id, bool(user_id))
+      else:
+        self.db.execute("update session set expires = %s where session_id = %s", (session_data['expires'], session_id))
     session = PostgresSession(self.db, session_data)
-    if data and hmac_data != base64.b64encode(hmac.new(str(user_id), data, hashlib.sha1).digest()):
+    if account_fields:
+      session.get_account()._set_loaded_properties(account_fields, dict((f, session_data['_account_' + f]) for f in account_fields))
+    if data and not signing.verify(str(user_id), data, hmac_data):
       raise TotoException(ERROR_INVALID_HMAC, "Invalid HMAC")
     session._verified = True
     return session
 
+  def _renew_sessions(self, session_ids, ttl):
+    self.db.execute("update session set expires = %s where session_id in (" + ','.join(['%s' for i in session_ids]) + ")", [time() + ttl] + list(session_ids))
+
   def remove_session(self, session_id):
     self.db.execute("delete from session where session_id = %s", (session_id,))
 
@@ -5,10 +5,9 @@ from time import time
 from datetime import datetime
 import base64
 import uuid
-import hmac
-import hashlib
 import cPickle as pickle
 import toto.secret as secret
+import toto.signing as signing
 from dbconnection import DBConnection
 
 def _account_key(user_id):
@@ -78,7 +77,7 @@ class RedisConnection(DBConnection):
     session._verified = True
     return session
 
-  def retrieve_session(self, session_id, hmac_data=None, data=None):
+  def retrieve_session(self, session_id, hmac_data=None, data=None, account_fields=None):
     session_key = _session_key(session_id)
     session_data = self.db.hgetall(session_key)
     if not session_data:
@@ -86,13 +85,28 @@ class RedisConnection(DBConnection):
     user_id = session_data['user_id']
     ttl = (user_id and self.session_ttl or self.anon_session_ttl)
     session_data['expires'] = time() + ttl
-    self.db.expire(session_key, ttl)
+    pipeline = self.db.pipeline(transaction=False)
+    if self._session_renewer is not None:
+      self._session_renewer.renew(session_id, bool(user_id))
+    else:
+      pipeline.expire(session_key, ttl)
+    if user_id and account_fields:
+      pipeline.hmget(_account_key(user_id), account_fields)
+    results = pipeline.execute()
     session = RedisSession(self.db, session_data)
-    if data and hmac_data != base64.b64encode(hmac.new(str(user_id), data, hashlib.sha1).digest()):
+    if user_id and account_fields:
+      session.get_account()._set_loaded_properties(account_fields, dict(zip(account_fields, results[-1])))
+    if data and not signing.verify(str(user_id), data, hmac_data):
       raise TotoException(ERROR_INVALID_HMAC, "Invalid HMAC")
     session._verified = True
     return session
 
+  def _renew_sessions(self, session_ids, ttl):
+    pipeline = self.db.pipeline(transaction=False)
+    for session_id in session_ids:
+      pipeline.expire(_session_key(session_id), ttl)
+    pipeline.execute()
+
   def remove_session(self, session_id):
     session_key = _session_key(session_id)
     self.db.delete(session_key)
@@ -0,0 +1,77 @@
+'''``toto.serialization`` keeps the registry of codecs used to parse requests and serialize responses. Codecs are
+selected by content type, so support for a new protocol can be added by registering a codec at startup::
+
+  from toto.serialization import register_codec
+  import yaml
+
+  register_codec('application/x-yaml', yaml.safe_load, yaml.safe_dump)
+
+By default, only "application/json" is registered. "application/bson" and "application/msgpack" are added
+by ``configure()`` if enabled with ``--bson_enabled`` and ``--msgpack_enabled``. The JSON backend can be
+replaced by a faster module with ``--json_module``, e.g. ``--json_module=ujson``.
+'''
+
+import json
+import logging
+from tornado.options import define, options
+
+define("bson_enabled", default=False, help="Allows requests to use BSON with content-type application/bson")
+define("msgpack_enabled", default=False, help="Allows requests to use MessagePack with content-type application/msgpack")
+define("json_module", default=None, type=str, help="The module to use for JSON serialization, e.g. 'ujson' or 'simplejson'. The module must have 'loads' and 'dumps' methods. If not set, or if the module cannot be imported, Python's json module will be used")
+
+class Codec(object):
+  '''Pairs the ``loads`` and ``dumps`` functions used to parse and serialize ``content_type``. When a sequence
+  of objects is streamed with this codec, the serialized objects are written between ``stream_prefix`` and
+  ``stream_suffix``, separated by ``stream_separator``.
+  '''
+
+  def __init__(self, content_type, loads, dumps, stream_prefix='', stream_separator='', stream_suffix=''):
+    self.content_type = content_type
+    self.loads = loads
+    self.dumps = dumps
+    self.stream_prefix = stream_prefix
+    self.stream_separator = stream_separator
+    self.stream_suffix = stream_suffix
+
+  def __repr__(self):
+    return '<Codec %s>' % self.content_type
+
+#the shared JSON codec, configure() updates this instance in place when --json_module is set
+JSON = Codec('application/json', json.loads, json.dumps, '[', ',', ']')
+
+_codecs = {JSON.content_type: JSON}
+
+def register_codec(content_type, loads, dumps, stream_prefix='', stream_separator='', stream_suffix=''):
+  '''Register ``loads`` and ``dumps`` as the codec for ``content_type``, replacing any existing codec. By default,
+  streamed objects are simply concatenated, see ``Codec`` for the framing options.
+  '''
+  _codecs[content_type] = Codec(content_type, loads, dumps, stream_prefix, stream_separator, stream_suffix)
+  return _codecs[content_type]
+
+def remove_codec(content_type):
+  '''Remove the codec registered for ``content_type``.'''
+  _codecs.pop(content_type, None)
+
+def codec(content_type):
+  '''Returns the codec registered for ``content_type`` (ignoring any parameters such as "charset"),
+  or ``None`` if there is no such codec.
+  '''
+  try:
+    return _codecs[content_type]
+  except KeyError:
+    return _codecs.get(content_type.split(';', 1)[0].strip().lower())
+
+def configure():
+  '''Select the JSON backend and register optional codecs according to ``tornado.options``.'''
+  if options.json_module:
+    try:
+      module = __import__(options.json_module)
+      JSON.loads, JSON.dumps = module.loads, module.dumps
+    except ImportError:
+      logging.warning("Unable to import JSON module '%s', falling back to json" % options.json_module)
+  if options.bson_enabled:
+    from bson import BSON
+    register_codec('application/bson', lambda data: BSON(data).decode(), lambda obj: str(BSON.encode(obj)))
+  if options.msgpack_enabled:
+    import msgpack
+    register_codec('application/msgpack', msgpack.loads, msgpack.dumps)
@@ -17,18 +17,33 @@ from tornado.web import *
 from tornado.ioloop import *
 from tornado.options import define, options
 from handler import TotoHandler
-from toto.service import TotoService
+from toto.service import TotoService, process_count
 from dbconnection import configured_connection
+from toto.wireformat import WireFormat
+from toto.workerproxy import WorkerProxy
+from toto.cpupool import CPUPool
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+import socket
+import signal
+import errno
+import time
+from exceptions import *
+from multiprocessing import Process
 import logging
 
-define("port", default=8888, help="The port to run this server on. Multiple daemon servers will be numbered sequentially starting at this port.")
+define("port", default=8888, help="The port to run this server on. Multiple daemon servers will be numbered sequentially starting at this port unless port_mode is 'shared' or 'reuseport'.")
+define("port_mode", default='separate', metavar='separate|shared|reuseport', help="With 'separate', each server process listens on its own port starting at port. With 'shared', the listening socket is bound once before the server processes are started and all processes accept connections from it. With 'reuseport', each process binds port with SO_REUSEPORT so the kernel balances connections between them (Linux 3.9+, falls back to 'shared' if unavailable)")
 define("root", default='/', help="The path to run the server on. This can be helpful when hosting multiple services on the same domain")
 define("method_module", default='methods', help="The root module to use for method lookup")
+define("method_manifest", default='', help="The path to a JSON method manifest (see toto.methodregistry). If set, method modules are imported the first time each method is called instead of at startup. Options defined in those modules can only be given their defaults")
 define("cookie_secret", default=None, type=str, help="A long random string to use as the HMAC secret for secure cookies, ignored if use_cookies is not enabled")
 define("autoreload", default=False, help="This option autoreloads modules as changes occur - useful for debugging.")
 define("remote_event_receivers", type=str, help="A comma separated list of remote event address that this event manager should connect to. e.g.: 'tcp://192.168.1.2:8889'", multiple=True)
 define("event_mode", default='off', metavar='off|on|only', help="This option enables or disables the event system, also providing an option to launch this server as an event server only")
 define("event_init_module", default=None, type=str, help="If defined, this module's 'invoke' function will be called with the EventManager instance after the main event handler is registered (e.g.: myevents.setup)")
+define("event_receive_thread", default=False, help="Receive events on a background thread instead of the main IOLoop. Event handlers registered with run_on_main_loop=False will run on that thread")
+define("event_routing", default='broadcast', metavar='broadcast|subscription', help="With subscription routing, events are only sent to servers with handlers registered for them. All servers and workers sending events must use the same routing")
 define("event_port", default=8999, help="The address to listen to event connections on - due to message queuing, servers use the next higher port as well")
 define("startup_function", default=None, type=str, help="An optional function to run on startup - e.g. module.function. The function will be called for each server instance before the server start listening as function(connection=<active database connection>, application=<tornado.web.Application>).")
 define("use_cookies", default=False, help="Select whether to use cookies for session storage, replacing the x-toto-session-id header. You must set cookie_secret if using this option and secure_cookies is not set to False")
@@ -41,6 +56,18 @@ define("use_web_sockets", default=False, help="Whether or not web sockets should
 define("socket_path", default='websocket', help="The path to use for websocket connections")
 define("client_side_worker_path", default="", help="The path to use for client side worker connections - functionality will be disabled if this is not set.")
 
+def _reuse_port_option():
+  return getattr(socket, 'SO_REUSEPORT', sys.platform.startswith('linux') and 15 or None)
+
+def _bind_reuse_port(port, backlog=128):
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  sock.setsockopt(socket.SOL_SOCKET, _reuse_port_option(), 1)
+  sock.setblocking(0)
+  sock.bind(('', port))
+  sock.listen(backlog)
+  return [sock]
+
 class TotoServer(TotoService):
   '''Instances can be configured in three ways:
 
@@ -53,29 +80,15 @@ class TotoServer(TotoService):
   Keyword args, config file, command line
   '''
 
+  module_options = ('method_module', 'socket_method_module', 'event_init_module')
+  function_options = ('startup_function', 'socket_opened_method', 'socket_closed_method')
+
   def __init__(self, conf_file=None, **kwargs):
-    module_options = {'method_module', 'socket_method_module', 'event_init_module'}
-    function_options = {'startup_function', 'socket_opened_method', 'socket_closed_method'}
-    original_argv, sys.argv = sys.argv, [i for i in sys.argv if i.strip('-').split('=')[0] in module_options]
-    self._load_options(conf_file, **{i: kwargs[i] for i in kwargs if i in module_options})
-    modules = {getattr(options, i) for i in module_options if getattr(options, i)}
-    for module in modules:
-      __import__(module)
-    function_modules = {getattr(options, i).rsplit('.', 1)[0] for i in function_options if getattr(options, i)}
-    for module in function_modules:
-      __import__(module)
-    sys.argv = original_argv
     #clear root logger handlers to prevent duplicate logging if user has specified a log file
     super(TotoServer, self).__init__(conf_file, **kwargs)
-    #clear method_module references so we can fully reload with new options
-    for module in modules:
-      for i in (m for m in sys.modules.keys() if m.startswith(module)):
-        del sys.modules[i]
-    for module in function_modules:
-      for i in (m for m in sys.modules.keys() if m.startswith(module)):
-        del sys.modules[i]
-    #prevent the reloaded module from re-defining options
-    define, tornado.options.define = tornado.options.define, lambda *args, **kwargs: None
+    self.__configure()
+
+  def __configure(self):
     self.__event_init = options.event_init_module and __import__(options.event_init_module) or None
     TotoHandler.configure()
     if options.use_web_sockets:
@@ -84,9 +97,60 @@ class TotoServer(TotoService):
     if options.client_side_worker_path:
       from clientsideworker import ClientSideWorkerSocketHandler
       ClientSideWorkerSocketHandler.configure()
-    tornado.options.define = define
+
+  def reload(self):
+    '''Reimport the method modules (and other modules named in options) and replace the ``@cpu_bound`` pool so
+    reloaded server processes run the latest code.
+    '''
+    self._reimport_modules()
+    self.__configure()
+    #the old server processes use the old pool until they have all been replaced and drained
+    CPUPool.reload(process_count() * options.reload_interval + options.drain_timeout + 5)
+
+  def __drain(self, http_server, db_connection):
+    #stop accepting connections and give requests in progress --drain_timeout seconds to finish
+    http_server.stop()
+    if options.use_web_sockets:
+      from sockets import TotoSocketHandler
+      for socket_handler in list(TotoSocketHandler.open_sockets):
+        socket_handler.close()
+    worker_connection = sys.modules.get('toto.workerconnection')
+    worker_connection = worker_connection and getattr(worker_connection.WorkerConnection, '_instance', None)
+    deadline = time.time() + options.drain_timeout
+    io_loop = IOLoop.instance()
+    def check():
+      if (TotoHandler.active_requests or (worker_connection and len(worker_connection))) and time.time() < deadline:
+        io_loop.add_timeout(time.time() + 0.1, check)
+        return
+      for handler in list(TotoHandler.active_requests):
+        if not handler._finished:
+          handler.respond(error=TotoException(ERROR_SERVER, "Server shutting down"))
+      if db_connection._session_renewer is not None:
+        db_connection._session_renewer.stop()
+      io_loop.stop()
+    check()
+
+  def prepare(self):
+    self.port_mode = options.port_mode
+    if self.port_mode == 'reuseport' and not _reuse_port_option():
+      logging.warning('SO_REUSEPORT is not available, falling back to port_mode=shared')
+      self.port_mode = 'shared'
+    #method modules were imported by configure() in __init__, so they are shared with the server processes
+    self.sockets = self.port_mode == 'shared' and bind_sockets(options.port) or None
+    self.worker_proxy = None
+    if options.worker_proxy_address:
+      import toto.workerconnection
+      proxy = WorkerProxy(options.worker_proxy_address, options.worker_address, options.worker_proxy_connections, options.worker_retry_ms, options.worker_retry_backoff, options.worker_retry_max_ms, options.worker_max_attempts)
+      self.worker_proxy = Process(target=proxy.run)
+      self.worker_proxy.daemon = True
+      self.worker_proxy.start()
+      print 'Starting worker proxy. Listening on "%s". Connecting to "%s"' % (options.worker_proxy_address, options.worker_address)
+    if CPUPool.instance():
+      CPUPool.instance().start()
 
   def main_loop(self):
+    if CPUPool.instance():
+      CPUPool.instance().attach()
     db_connection = configured_connection()
   
     application_settings = {}
@@ -104,12 +168,16 @@ class TotoServer(TotoService):
       from toto.events import EventManager
       event_manager = EventManager.instance()
       event_manager.address = 'tcp://*:%s' % (options.event_port + self.service_id)
-      event_manager.start_listening()
+      event_manager.routing = options.event_routing
+      event_manager.wire_format = WireFormat.instance()
+      event_manager.start_listening(options.event_receive_thread)
       for i in xrange(options.processes > 0 and options.processes or multiprocessing.cpu_count()):
         event_manager.register_server('tcp://127.0.0.1:%s' % (options.event_port + i))
       if options.remote_event_receivers:
         for address in options.remote_event_receivers:
           event_manager.register_server(address)
+      if options.session_cache_size > 0:
+        db_connection.enable_remote_invalidation(event_manager)
       init_module = self.__event_init
       if init_module:
         init_module.invoke(event_manager)
@@ -122,7 +190,23 @@ class TotoServer(TotoService):
       startup_path = options.startup_function.rsplit('.')
       __import__(startup_path[0]).__dict__[startup_path[1]](db_connection=db_connection, application=application)
   
-    port = options.port + self.service_id
-    application.listen(port)
+    http_server = HTTPServer(application)
+    if self.port_mode == 'separate':
+      port = options.port + self.service_id
+      #during a reload, the process being replaced may still be releasing the port
+      for attempt in xrange(50):
+        try:
+          http_server.listen(port)
+          break
+        except socket.error as e:
+          if e.errno != errno.EADDRINUSE or attempt == 49:
+            raise
+          time.sleep(0.1)
+    else:
+      port = options.port
+      http_server.add_sockets(self.sockets or _bind_reuse_port(port))
+    io_loop = IOLoop.instance()
+    add_callback = getattr(io_loop, 'add_callback_from_signal', io_loop.add_callback)
+    signal.signal(signal.SIGTERM, lambda signum, frame: add_callback(lambda: self.__drain(http_server, db_connection)))
     print "Starting server on port %s" % port
-    IOLoop.instance().start()
+    io_loop.start()
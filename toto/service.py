@@ -1,7 +1,8 @@
 '''``TotoService`` can be used to write general processes that take advantage of the process creation/management features
   used by ``TotoServer`` and ``TotoWorker`` - the two built in subclasses of ``TotoService``.  ``TotoService`` subclasses can be
   run with the ``--start`` (or ``--stop``)  and ``--processes`` options
-  to start the service as a daemon process or run multiple instances simultaneously.
+  to start the service as a daemon process or run multiple instances simultaneously. A running daemon can be
+  reloaded with ``--reload``, which replaces its processes one at a time, and processes that crash are restarted.
   
   To run a subclass of ``TotoService`` create a script like this::
 
@@ -17,19 +18,27 @@
 '''
 
 import os
+import sys
+import signal
 import tornado
 import logging
 from tornado.options import define, options
 from multiprocessing import Process, cpu_count
-from time import sleep
+from time import sleep, time
+from traceback import format_exc
 
-define("daemon", metavar='start|stop|restart', help="Start, stop or restart this script as a daemon process. Use this setting in conf files, the shorter start, stop, restart aliases as command line arguments. Requires the multiprocessing module.")
+define("daemon", metavar='start|stop|restart|reload', help="Start, stop, restart or reload this script as a daemon process. Use this setting in conf files, the shorter start, stop, restart, reload aliases as command line arguments. Requires the multiprocessing module.")
 define("processes", default=1, help="The number of daemon processes to run")
 define("pidfile", default="toto.daemon.pid", help="The path to the pidfile for daemon processes will be named <path>.<num>.pid (toto.daemon.pid -> toto.daemon.0.pid)")
 define("start", default=False, help="Alias for daemon=start for command line usage - overrides daemon setting.")
 define("stop", default=False, help="Alias for daemon=start for command line usage - overrides daemon setting.")
 define("restart", default=False, help="Alias for daemon=start for command line usage - overrides daemon setting.")
+define("reload", default=False, help="Alias for daemon=reload for command line usage - overrides daemon setting. Sends SIGHUP to the running daemon, which replaces its processes one at a time without dropping requests.")
+define("drain_timeout", default=10.0, help="When a service process is stopped with SIGTERM (or replaced during a reload), it will stop accepting new work and wait up to this many seconds for work in progress to finish")
+define("respawn", default=True, help="Restart service processes that exit unexpectedly")
+define("reload_interval", default=1.0, help="The number of seconds to wait between replacing each process during a reload")
 define("nodaemon", default=False, help="Alias for daemon='' for command line usage - overrides daemon setting.")
+define("reimport_modules", default=False, help="Import the modules named in options twice on startup: once so they can define options and again after they have been removed from sys.modules and all options are parsed. By default modules are imported once, and options they define are set as soon as they are defined")
 define("debug", default=False, help="Set this to true to prevent Toto from nicely formatting generic errors. With debug=True, errors will print to the command line")
 
 #convert p to the absolute path, insert ".i" before the last "." or at the end of the path
@@ -58,12 +67,23 @@ def process_count():
   '''
   return options.processes if options.processes >= 0 else cpu_count()
 
+def _option_name(arg):
+  return arg.lstrip('-').partition('=')[0].replace('-', '_')
+
 
 class TotoService(object):
   '''Subclass ``TotoService`` to create a service that can be easily daemonised or
   ran in multiple processes simultaneously.
+
+  Set ``module_options`` to the names of options that name modules (e.g. ``method_module``) and
+  ``function_options`` to the names of options that name functions (e.g. ``module.function``) and the
+  modules will be imported when the service is initialized. Options defined by those modules can be
+  set in the config file, keyword arguments or on the command line like any other option.
   '''
 
+  module_options = ()
+  function_options = ()
+
   def _load_options(self, conf_file=None, **kwargs):
     for k in kwargs:
       options[k].set(kwargs[k])
@@ -76,6 +96,8 @@ class TotoService(object):
       options['daemon'].set('stop')
     elif options.restart:
       options['daemon'].set('restart')
+    elif options.reload:
+      options['daemon'].set('reload')
     elif options.nodaemon:
       options['daemon'].set('')
 
@@ -84,45 +106,171 @@ class TotoService(object):
       root_logger = logging.getLogger()
       for handler in [h for h in root_logger.handlers]:
         root_logger.removeHandler(handler)
-    self._load_options(conf_file, **kwargs)
+    if self.module_options or self.function_options:
+      self.__import_modules(conf_file, kwargs)
+    else:
+      self._load_options(conf_file, **kwargs)
+
+  def __module_names(self):
+    modules = {getattr(options, i) for i in self.module_options if getattr(options, i)}
+    return modules | {getattr(options, i).rsplit('.', 1)[0] for i in self.function_options if getattr(options, i)}
+
+  def __import_modules(self, conf_file, kwargs):
+    #parse everything that is already defined, leaving the rest (and --help) until the modules have defined their options
+    argv = sys.argv
+    deferred = [a for a in argv[1:] if a.startswith('-') and (_option_name(a) not in options or _option_name(a) == 'help')]
+    sys.argv = [a for a in argv if a not in deferred]
+    try:
+      self._load_options(conf_file, **{k: kwargs[k] for k in kwargs if k in options})
+    finally:
+      sys.argv = argv
+    if options.reimport_modules:
+      for module in self.__module_names():
+        __import__(module)
+      self.__reparse(lambda: self._load_options(conf_file, **kwargs))
+      self._reimport_modules()
+      return
+    config = {}
+    if conf_file:
+      execfile(conf_file, config, config)
+    #set options as soon as they are defined, so modules see their configured values while they are imported
+    define = tornado.options.define
+    def define_and_set(name, *args, **kw):
+      define(name, *args, **kw)
+      option = options[name]
+      if name in kwargs:
+        option.set(kwargs[name])
+      if name in config:
+        option.set(config[name])
+      for arg in (a for a in deferred if _option_name(a) == name):
+        value = arg.partition('=')
+        if value[1] or option.type == bool:
+          option.parse(value[2] if value[1] else 'true')
+    tornado.options.define = define_and_set
+    try:
+      for module in self.__module_names():
+        __import__(module)
+    finally:
+      tornado.options.define = define
+    if deferred:
+      #reports any options that are still unknown and prints --help with the modules' options included
+      self.__reparse(lambda: tornado.options.parse_command_line([argv[0]] + deferred))
+
+  def __reparse(self, parse):
+    #parsing the command line sets up logging every time, so drop the log handlers added after the first parse
+    root_logger = logging.getLogger()
+    handlers = list(root_logger.handlers)
+    parse()
+    for handler in [h for h in root_logger.handlers if h not in handlers]:
+      root_logger.removeHandler(handler)
+
+  def _reimport_modules(self):
+    '''Remove the modules named in ``module_options`` and ``function_options`` (and their submodules) from
+    ``sys.modules`` and import them again. Options defined by the modules are not redefined.
+    '''
+    modules = self.__module_names()
+    for module in modules:
+      for i in (m for m in sys.modules.keys() if m.startswith(module)):
+        del sys.modules[i]
+    #prevent the reloaded module from re-defining options
+    define, tornado.options.define = tornado.options.define, lambda *args, **kwargs: None
+    try:
+      for module in modules:
+        __import__(module)
+    finally:
+      tornado.options.define = define
 
   def __run_service(self, pidfile=None):
 
     def start_server_process(pidfile, service_id=0):
+      for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGCHLD):
+        signal.signal(signum, signal.SIG_DFL)
       self.service_id = service_id
       self.main_loop()
-      if pidfile:
-        os.remove(pidfile)
-    count = process_count()
-    processes = []
-    pidfiles = options.daemon and [pid_path(i) for i in xrange(1, count + 1)] or []
-    self.prepare()
-    for i in xrange(count):
+      if pidfile and os.path.exists(pidfile):
+        with open(pidfile, 'r') as f:
+          if f.read() == str(os.getpid()):
+            os.remove(pidfile)
+
+    def start_process(i):
       proc = Process(target=start_server_process, args=(pidfiles and pidfiles[i], i))
       proc.daemon = True
-      processes.append(proc)
       proc.start()
-    else:
-      print "Starting %s %s process%s." % (count, self.__class__.__name__, count > 1 and 'es' or '')
-    if options.daemon:
-      i = 1
-      for proc in processes:
-        with open(pidfiles[i - 1], 'w') as f:
+      if pidfiles:
+        with open(pidfiles[i], 'w') as f:
           f.write(str(proc.pid))
-        i += 1
-    for proc in processes:
-      proc.join()
+      return proc
+
+    count = process_count()
+    pidfiles = options.daemon and [pid_path(i) for i in xrange(1, count + 1)] or []
+    self.prepare()
+    processes = [start_process(i) for i in xrange(count)]
+    print "Starting %s %s process%s." % (count, self.__class__.__name__, count > 1 and 'es' or '')
+    self.__supervise(processes, start_process)
     self.finish()
     if pidfile:
       os.remove(pidfile)
 
+  def __supervise(self, processes, start_process):
+    state = {'reload': False, 'stop': False}
+    draining = []
+    def request_reload(signum, frame):
+      state['reload'] = True
+    def request_stop(signum, frame):
+      state['stop'] = True
+      for proc in processes:
+        if proc and proc.is_alive():
+          proc.terminate()
+    signal.signal(signal.SIGHUP, request_reload)
+    signal.signal(signal.SIGTERM, request_stop)
+    #wake from sleep() as soon as a child exits
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    while any(processes) or draining:
+      if state['reload'] and not state['stop']:
+        state['reload'] = False
+        logging.info('Reloading %s' % self.__class__.__name__)
+        try:
+          self.reload()
+        except Exception:
+          #e.g. a syntax error in a reloaded module, keep serving with the running processes
+          logging.error('Reload failed, keeping the existing processes\n%s' % format_exc())
+          continue
+        #replace processes one at a time, old processes drain in the background
+        for i, proc in enumerate(processes):
+          if state['stop']:
+            break
+          if proc:
+            proc.terminate()
+            draining.append((proc, time() + options.drain_timeout + 5))
+          processes[i] = start_process(i)
+          sleep(options.reload_interval)
+      for i, proc in enumerate(processes):
+        if not proc or proc.is_alive():
+          continue
+        processes[i] = None
+        #clean exits and SIGTERM (e.g. --stop) are intentional
+        if options.respawn and not state['stop'] and proc.exitcode not in (0, -signal.SIGTERM):
+          logging.error('%s process %s exited with %s, restarting' % (self.__class__.__name__, proc.pid, proc.exitcode))
+          processes[i] = start_process(i)
+      for entry in list(draining):
+        proc, deadline = entry
+        if not proc.is_alive():
+          draining.remove(entry)
+        elif time() > deadline:
+          logging.warning('%s process %s did not stop after %s seconds, killing' % (self.__class__.__name__, proc.pid, options.drain_timeout))
+          os.kill(proc.pid, signal.SIGKILL)
+      sleep(1)
+    for proc in processes:
+      if proc:
+        proc.join()
+
   def run(self): 
     '''Start the service. Depending on the initialization options, this may run more than one
     service process.
     '''
     if options.daemon:
       import multiprocessing
-      import signal, re
+      import re
 
       pattern = pid_path(r'\d+').replace('.', r'\.')
       piddir = os.path.dirname(pattern)
@@ -178,7 +326,16 @@ class TotoService(object):
           else:
             self.__run_service(master_pidfile)
 
-      if options.daemon not in ('start', 'stop', 'restart'):
+      if options.daemon == 'reload':
+        try:
+          with open(master_pidfile, 'rb') as f:
+            master_pid = int(f.read())
+          os.kill(master_pid, signal.SIGHUP)
+          print "Reloading %s %s" % (self.__class__.__name__, master_pid)
+        except (OSError, IOError, ValueError) as e:
+          print "Unable to reload %s: %s" % (self.__class__.__name__, e)
+
+      if options.daemon not in ('start', 'stop', 'restart', 'reload'):
         print "Invalid daemon option: " + options.daemon
 
     else:
@@ -194,6 +351,17 @@ class TotoService(object):
     '''Subclass ``TotoService`` and override ``main_loop()`` with your desired functionality.'''
     raise NotImplementedError()
 
+  def reload(self):
+    '''Override this method in a ``TotoService`` subclass and it will be called when the service receives
+    ``SIGHUP`` (e.g. from ``--reload``), before the service processes are replaced. New processes are forked from
+    the supervising process, so anything reloaded here will be used by them.
+
+    Service processes are stopped with ``SIGTERM``. To finish work in progress before exiting, handle ``SIGTERM``
+    in ``main_loop()`` and return within ``--drain_timeout`` seconds. Processes that exit with any status other
+    than zero or ``-SIGTERM`` are restarted unless ``--respawn`` is disabled.
+    '''
+    pass
+
   def finish(self):
     '''Override this method in a ``TotoService`` subclass and it will be called after all service processes
     have exited (after each ``main_loop()`` has returned).
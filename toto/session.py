@@ -31,8 +31,11 @@ class TotoAccount(object):
     return self.__iter__()
 
   def save(self):
-    '''Save any modified keys to the user account stored in the database.
+    '''Save any modified keys to the user account stored in the database. All modified keys are
+    written together, so set every property you want to change before calling ``save()``.
     '''
+    if not self._modified_properties:
+      return
     self._save_property(*self._modified_properties)
     self._modified_properties.clear()
 
@@ -41,9 +44,13 @@ class TotoAccount(object):
     but if you know you'll be referencing multiple properties, it can be faster to load them in bulk
     by passing all the keys you want to load as arguments to this method first.
     '''
-    loaded = self._load_property(*args)
-    for k in loaded:
-      self._properties[k] = loaded[k]
+    return self._set_loaded_properties(args, self._load_property(*args))
+
+  def _set_loaded_properties(self, keys, loaded):
+    #keys missing from the database are stored as None so they are not loaded again
+    loaded = loaded or {}
+    for k in keys:
+      self._properties[k] = loaded.get(k)
     return self
 
   def __str__(self):
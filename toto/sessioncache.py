@@ -0,0 +1,197 @@
+'''``CachedSessionConnection`` adds an in-process session cache to any ``DBConnection``. Sessions are cached for up
+to ``ttl`` seconds (or until they expire) and at most ``max_size`` sessions are kept, least recently used first.
+``TotoServer`` will use a ``CachedSessionConnection`` when ``--session_cache_size`` is greater than zero.
+
+Cached sessions are invalidated by ``remove_session()``, ``clear_sessions()``, ``change_password()``,
+``generate_password()`` and by saving a session. When the event system is enabled, invalidations are
+broadcast to all other servers so sessions stay consistent across processes.
+
+Each call to ``retrieve_session()`` returns a separate copy of the cached session, so changes to session
+state are not visible to other requests until the session is saved. Sessions served from the cache are only
+renewed if lazy renewal is enabled with ``--session_renew_interval``.
+'''
+
+import copy
+from collections import OrderedDict
+from threading import Lock
+from time import time
+from dbconnection import DBConnection
+from exceptions import *
+from tasks import Future
+import signing
+
+INVALIDATE_EVENT = 'toto.sessioncache.invalidate'
+
+class CachedSessionConnection(DBConnection):
+  '''Wraps ``connection`` and caches the sessions it returns from ``retrieve_session()``. Any attributes not
+  defined here are read from ``connection``.
+  '''
+
+  def __init__(self, connection, max_size=10000, ttl=60):
+    self.connection = connection
+    self.db = connection.db
+    self.max_size = max_size
+    self.ttl = ttl
+    self.__sessions = OrderedDict()
+    self.__user_sessions = {}
+    self.__lock = Lock()
+    self.__event_manager = None
+
+  def __getattr__(self, name):
+    return getattr(self.connection, name)
+
+  def __len__(self):
+    return len(self.__sessions)
+
+  @property
+  def async_thread_limit(self):
+    return self.connection.async_thread_limit
+
+  @property
+  def _session_renewer(self):
+    #DBConnection defines _session_renewer, so it would not reach __getattr__
+    return self.connection._session_renewer
+
+  def enable_lazy_renewal(self, interval):
+    self.connection.enable_lazy_renewal(interval)
+
+  def enable_remote_invalidation(self, event_manager):
+    '''Broadcast invalidations with ``event_manager`` and apply invalidations received from other servers.'''
+    self.__event_manager = event_manager
+    event_manager.register_handler(INVALIDATE_EVENT, self.__remote_invalidate, persist=True)
+
+  def __remote_invalidate(self, args):
+    self.__invalidate(args.get('session_ids', ()), args.get('user_ids', ()))
+
+  def __invalidate(self, session_ids=(), user_ids=()):
+    with self.__lock:
+      for user_id in user_ids:
+        session_ids = list(session_ids) + list(self.__user_sessions.pop(user_id, ()))
+      for session_id in session_ids:
+        entry = self.__sessions.pop(session_id, None)
+        if entry:
+          self.__discard_user_session(entry[1].user_id, session_id)
+
+  def __discard_user_session(self, user_id, session_id):
+    user_sessions = self.__user_sessions.get(user_id)
+    if user_sessions:
+      user_sessions.discard(session_id)
+      if not user_sessions:
+        del self.__user_sessions[user_id]
+
+  def invalidate(self, session_ids=(), user_ids=()):
+    '''Remove the sessions matching ``session_ids`` and all sessions belonging to ``user_ids`` from this
+    cache and, if remote invalidation is enabled, the caches of all other servers.
+    '''
+    self.__invalidate(session_ids, user_ids)
+    if self.__event_manager:
+      self.__event_manager.send(INVALIDATE_EVENT, {'session_ids': list(session_ids), 'user_ids': list(user_ids)})
+
+  def clear(self):
+    '''Remove all sessions from this cache.'''
+    with self.__lock:
+      self.__sessions.clear()
+      self.__user_sessions.clear()
+
+  def __store(self, session):
+    session = self.__copy(session)
+    with self.__lock:
+      self.__sessions.pop(session.session_id, None)
+      self.__sessions[session.session_id] = (time() + self.ttl, session)
+      self.__user_sessions.setdefault(session.user_id, set()).add(session.session_id)
+      while len(self.__sessions) > self.max_size:
+        session_id, entry = self.__sessions.popitem(False)
+        self.__discard_user_session(entry[1].user_id, session_id)
+
+  def __load(self, session_id):
+    with self.__lock:
+      entry = self.__sessions.pop(session_id, None)
+      if not entry:
+        return None
+      if entry[0] < time() or entry[1].expires < time():
+        self.__discard_user_session(entry[1].user_id, session_id)
+        return None
+      self.__sessions[session_id] = entry
+    return self.__copy(entry[1])
+
+  def __copy(self, session):
+    session = copy.copy(session)
+    session.__dict__.pop('_account', None)
+    session.__dict__.pop('save', None)
+    session.state = copy.deepcopy(session.state)
+    return session
+
+  def __watch(self, session):
+    save = session.save
+    def watched_save():
+      save()
+      self.invalidate((session.session_id,))
+    session.save = watched_save
+    return session
+
+  def create_account(self, user_id, password, additional_values={}, **values):
+    return self.connection.create_account(user_id, password, additional_values, **values)
+
+  def create_session(self, user_id=None, password=None, verify_password=True):
+    session = self.connection.create_session(user_id, password, verify_password)
+    return session and self.__watch(session)
+
+  def retrieve_session(self, session_id, hmac_data=None, data=None, account_fields=None):
+    session = self.__retrieve_cached(session_id, hmac_data, data)
+    if not session:
+      return self.__retrieve(session_id, hmac_data, data, account_fields)
+    if account_fields:
+      session.get_account().load_property(*account_fields)
+    return session
+
+  def retrieve_session_async(self, session_id, hmac_data=None, data=None, account_fields=None):
+    #cached sessions are returned without leaving the IOLoop thread unless account properties are needed
+    future = Future()
+    try:
+      session = self.__retrieve_cached(session_id, hmac_data, data)
+    except Exception as e:
+      future.set_exception(e)
+      return future
+    if not session:
+      return self.run_async(self.__retrieve, session_id, hmac_data, data, account_fields)
+    if account_fields:
+      return self.run_async(lambda: session.get_account().load_property(*account_fields) and session)
+    future.set_result(session)
+    return future
+
+  def __retrieve(self, session_id, hmac_data, data, account_fields=None):
+    session = self.connection.retrieve_session(session_id, hmac_data, data, account_fields)
+    if session:
+      self.__store(session)
+      self.__watch(session)
+    return session
+
+  def __retrieve_cached(self, session_id, hmac_data, data):
+    session = self.__load(session_id)
+    if not session:
+      return None
+    if data and not signing.verify(str(session.user_id), data, hmac_data):
+      raise TotoException(ERROR_INVALID_HMAC, "Invalid HMAC")
+    renewer = self._session_renewer
+    if renewer is not None:
+      renewer.renew(session_id, bool(session.user_id))
+      session.expires = time() + (session.user_id and self.connection.session_ttl or self.connection.anon_session_ttl)
+    session._verified = True
+    return self.__watch(session)
+
+  def remove_session(self, session_id):
+    self.connection.remove_session(session_id)
+    self.invalidate((session_id,))
+
+  def clear_sessions(self, user_id):
+    self.connection.clear_sessions(user_id)
+    self.invalidate(user_ids=set((user_id, user_id.lower())))
+
+  def change_password(self, user_id, password, new_password):
+    self.connection.change_password(user_id, password, new_password)
+    self.invalidate(user_ids=set((user_id, user_id.lower())))
+
+  def generate_password(self, user_id):
+    new_password = self.connection.generate_password(user_id)
+    self.invalidate(user_ids=set((user_id, user_id.lower())))
+    return new_password
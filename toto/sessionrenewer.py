@@ -0,0 +1,71 @@
+'''``SessionRenewer`` coalesces session renewals. Instead of extending a session's expiry on every request,
+drivers queue the session ID with the renewer and the pending renewals are written to the database in bulk
+every ``--session_renew_interval`` seconds, so each active session costs at most one write per interval.
+The time each session was last extended is tracked and sessions extended within the last interval are
+not queued again.
+
+Renewals are written from a ``PeriodicCallback`` on the main ``IOLoop``. Drivers implement the bulk write
+in ``_renew_sessions(session_ids, ttl)``.
+'''
+
+from threading import Lock
+from time import time
+from tornado.ioloop import IOLoop, PeriodicCallback
+from traceback import format_exc
+import logging
+
+class SessionRenewer(object):
+  '''Queues renewals for ``connection`` and writes them every ``interval`` seconds in batches of up to
+  ``batch_size`` sessions.
+  '''
+
+  def __init__(self, connection, interval, batch_size=1000):
+    self.connection = connection
+    self.interval = interval
+    self.batch_size = batch_size
+    self.__pending = {}
+    self.__renewed = {}
+    self.__lock = Lock()
+    self.__callback = None
+
+  def __len__(self):
+    return len(self.__pending)
+
+  def renew(self, session_id, authenticated=True):
+    '''Queue the session matching ``session_id`` for renewal. Authenticated sessions are renewed with
+    the connection's ``session_ttl``, anonymous sessions with ``anon_session_ttl``.
+    '''
+    with self.__lock:
+      if self.__renewed.get(session_id, 0) > time() - self.interval:
+        return
+      self.__pending[session_id] = authenticated
+      if self.__callback:
+        return
+      self.__callback = PeriodicCallback(self.flush, self.interval * 1000)
+    IOLoop.instance().add_callback(self.__callback.start)
+
+  def flush(self):
+    '''Write all pending renewals to the database now.'''
+    now = time()
+    with self.__lock:
+      pending, self.__pending = self.__pending, {}
+      for session_id in [k for k, v in self.__renewed.iteritems() if v <= now - self.interval]:
+        del self.__renewed[session_id]
+      self.__renewed.update((session_id, now) for session_id in pending)
+    if not pending:
+      return
+    for authenticated, ttl in ((True, self.connection.session_ttl), (False, self.connection.anon_session_ttl)):
+      session_ids = [k for k, v in pending.iteritems() if v == authenticated]
+      for i in xrange(0, len(session_ids), self.batch_size):
+        try:
+          self.connection._renew_sessions(session_ids[i:i + self.batch_size], ttl)
+        except Exception as e:
+          logging.error(format_exc())
+
+  def stop(self):
+    '''Stop the periodic flush and write any pending renewals.'''
+    with self.__lock:
+      callback, self.__callback = self.__callback, None
+    if callback:
+      callback.stop()
+    self.flush()
@@ -0,0 +1,54 @@
+'''``toto.signing`` generates and verifies the base64 encoded HMAC-SHA1 signatures used in the ``x-toto-hmac``
+header. The keyed HMAC state for each key (normally a user ID) is computed once and reused for every
+request and response signed with that key. Up to ``--hmac_cache_size`` keys are kept, least recently
+used keys are discarded first.
+'''
+
+import hmac
+import hashlib
+import base64
+from collections import OrderedDict
+from threading import Lock
+from tornado.options import define, options
+
+define("hmac_cache_size", default=10000, help="The number of keyed HMAC states to keep for reuse when signing responses and verifying requests, or zero to disable caching")
+
+_lock = Lock()
+_keys = OrderedDict()
+
+def _keyed_hmac(key):
+  try:
+    with _lock:
+      keyed = _keys.pop(key)
+      _keys[key] = keyed
+  except KeyError:
+    keyed = hmac.new(key, digestmod=hashlib.sha1)
+    if options.hmac_cache_size > 0:
+      with _lock:
+        _keys[key] = keyed
+        while len(_keys) > options.hmac_cache_size:
+          _keys.popitem(False)
+  return keyed.copy()
+
+def clear_cache():
+  '''Discard all cached HMAC state.'''
+  with _lock:
+    _keys.clear()
+
+def sign(key, data):
+  '''Returns the base64 encoded HMAC-SHA1 of ``data`` using ``key``.'''
+  keyed = _keyed_hmac(key)
+  keyed.update(data)
+  return base64.b64encode(keyed.digest())
+
+def verify(key, data, signature):
+  '''Returns ``True`` if ``signature`` is the base64 encoded HMAC-SHA1 of ``data`` using ``key``.'''
+  if not signature:
+    return False
+  expected = sign(key, data)
+  if len(expected) != len(signature):
+    return False
+  result = 0
+  for x, y in zip(expected, signature):
+    result |= ord(x) ^ ord(y)
+  return result == 0
@@ -1,16 +1,19 @@
 from tornado.web import *
-import json
 from invocation import *
 from exceptions import *
 from tornado.options import define, options
 from events import EventManager
+import serialization
 from tornado.websocket import WebSocketHandler
 import logging
 
 class TotoSocketHandler(WebSocketHandler):
+  #open sockets, used to close them cleanly before the server exits
+  open_sockets = set()
 
   @classmethod
   def configure(cls):
+    serialization.configure()
     if options.debug:
       import traceback
       def log_error(self, e): 
@@ -43,6 +46,7 @@ class TotoSocketHandler(WebSocketHandler):
       return self.session
 
   def open(self, session_id=None):
+    TotoSocketHandler.open_sockets.add(self)
     if session_id:
       self.retrieve_session(session_id)
     if(self._on_open):
@@ -51,7 +55,7 @@ class TotoSocketHandler(WebSocketHandler):
   def on_message(self, message_data):
     method = self.__method
     try:
-      message = json.loads(message_data)
+      message = serialization.JSON.loads(message_data)
       for i in message['method'].split('.'):
         method = getattr(method, i)
       method.invoke(self, message['parameters'])
@@ -59,10 +63,14 @@ class TotoSocketHandler(WebSocketHandler):
       self.log_error(e)
 
   def send_message(self, data, message_id=None):
-    self.write_message(message_id and {'message_id': message_id, 'data': data} or data)
+    message = message_id and {'message_id': message_id, 'data': data} or data
+    #like write_message(), only dicts (and lists) are JSON encoded, anything else is sent as is
+    if isinstance(message, (dict, list)):
+      message = serialization.JSON.dumps(message)
+    self.write_message(message)
 
-  def register_event_handler(self, event_name, handler, run_on_main_loop=True, deregister_on_finish=False):
-    sig = EventManager.instance().register_handler(event_name, handler, run_on_main_loop, self)
+  def register_event_handler(self, event_name, handler, run_on_main_loop=True, deregister_on_finish=False, coalesce=None, window=0, max_batch=0):
+    sig = EventManager.instance().register_handler(event_name, handler, run_on_main_loop, self, coalesce=coalesce, window=window, max_batch=max_batch)
     if deregister_on_finish:
       self.registered_event_handlers.append(sig)
     return sig
@@ -72,7 +80,8 @@ class TotoSocketHandler(WebSocketHandler):
     self.registered_event_handlers.remove(sig)
 
   def on_close(self):
-    while self.registered_event_handlers:
-      self.deregister_event_handler(self.registered_event_handlers[0])
+    TotoSocketHandler.open_sockets.discard(self)
+    del self.registered_event_handlers[:]
+    EventManager.instance().remove_request_handler(self)
     if(self._on_close):
       self._on_close()
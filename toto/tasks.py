@@ -3,76 +3,270 @@ while limiting the number of active jobs. The task queue is designed primarily f
 shorter, lightweight jobs. For CPU intensive tasks or tasks that are expected to
 run for a long time, look at Toto's worker functionality instead.
 '''
-from threading import Thread, Lock
-from collections import deque
+from threading import Thread, Lock, Event
+from heapq import heappush, heappop, heapify
+from itertools import count
+from time import time
+from tornado.ioloop import IOLoop
+from exceptions import *
 import logging
 import traceback
 
+class Future(object):
+  '''A placeholder for the result of work running in the background. Functions passed to ``add_done_callback()``
+  are run on ``io_loop`` (the main ``IOLoop`` by default) once the result is available, so they may safely
+  write to a request handler. ``set_result()`` and ``set_exception()`` may be called from any thread, only the
+  first result or exception set on a future is kept.
+  '''
+
+  def __init__(self, io_loop=None):
+    self.io_loop = io_loop or IOLoop.instance()
+    self.__lock = Lock()
+    self.__event = Event()
+    self.__callbacks = []
+    self.__result = None
+    self.__exception = None
+
+  def done(self):
+    '''Returns ``True`` if the result (or an exception) has been set.'''
+    return self.__event.is_set()
+
+  def result(self, timeout=None):
+    '''Returns the result, raising the exception instead if one was set. If the result is not yet
+    available, the calling thread will wait up to ``timeout`` seconds for it. Never call this with
+    an incomplete future from the ``IOLoop`` thread.
+    '''
+    if not self.__event.wait(timeout):
+      raise RuntimeError("Future timed out")
+    if self.__exception:
+      raise self.__exception
+    return self.__result
+
+  def exception(self, timeout=None):
+    '''Returns the exception set on this future or ``None``. Waits like ``result()``.'''
+    if not self.__event.wait(timeout):
+      raise RuntimeError("Future timed out")
+    return self.__exception
+
+  def add_done_callback(self, fn):
+    '''Call ``fn(future)`` on ``io_loop`` when this future is done. Callbacks are run in the order they were added.'''
+    with self.__lock:
+      if not self.__event.is_set():
+        self.__callbacks.append(fn)
+        return
+    self.io_loop.add_callback(lambda: fn(self))
+
+  def set_result(self, result):
+    self.__set_done(result, None)
+
+  def set_exception(self, exception):
+    self.__set_done(None, exception)
+
+  def __set_done(self, result, exception):
+    with self.__lock:
+      if self.__event.is_set():
+        return
+      self.__result = result
+      self.__exception = exception
+      self.__event.set()
+      callbacks, self.__callbacks = self.__callbacks, []
+    for fn in callbacks:
+      self.io_loop.add_callback(lambda fn=fn: fn(self))
+
+def gather(futures, io_loop=None):
+  '''Returns a ``Future`` that resolves once every future in ``futures`` is done. If ``futures`` is a dictionary,
+  the result is a dictionary of the results stored under the same keys, otherwise it is a list of the results
+  in order. If any of the futures fails, the returned future fails with the first exception raised::
+
+    def invoke(handler, parameters):
+      handler.respond_future(gather({'a': workerconnection.invoke('a', parameters), 'b': workerconnection.invoke('b', parameters)}))
+  '''
+  if isinstance(futures, dict):
+    keys, results = futures.keys(), {}
+  else:
+    keys, results = range(len(futures)), [None] * len(futures)
+  gathered = Future(io_loop)
+  remaining = [len(keys)]
+  lock = Lock()
+  def complete(key, future):
+    exception = future.exception()
+    if exception:
+      gathered.set_exception(exception)
+      return
+    with lock:
+      results[key] = future.result()
+      remaining[0] -= 1
+      if remaining[0]:
+        return
+    gathered.set_result(results)
+  if not keys:
+    gathered.set_result(results)
+  for key in keys:
+    futures[key].add_done_callback(lambda future, key=key: complete(key, future))
+  return gathered
+
 class TaskQueue():
   '''Instances will run up to ``thread_count`` tasks at a time
-  whenever there are tasks in the queue.
+  whenever there are tasks in the queue. Threads are started as tasks
+  are added and kept alive for ``idle_timeout`` seconds (forever if zero)
+  after their last task so bursts of work don't repeatedly create new
+  threads. Idle threads wait without a timeout so they start new tasks
+  immediately, threads that have been idle for longer than ``idle_timeout``
+  exit the next time a task is added.
+
+  Tasks with a higher ``priority`` run first, tasks with the same priority
+  run in the order they were added. If ``max_size`` is greater than zero,
+  at most that many tasks will wait in the queue. Additional tasks are
+  handled according to ``rejection_policy``:
+
+  * "reject" - raise a ``TotoException`` with ``ERROR_LIMIT_EXCEEDED``.
+  * "caller_runs" - run the task immediately on the calling thread.
+  * "discard_oldest" - drop the oldest task with the lowest priority to make room. If it was added with
+    ``submit()``, its future fails with ``ERROR_LIMIT_EXCEEDED``.
   '''
 
-  def __init__(self, thread_count=1):
-    self.tasks = deque()
+  def __init__(self, thread_count=1, max_size=0, rejection_policy='reject', idle_timeout=60):
+    self.tasks = []
     self.running = False
     self.lock = Lock()
     self.threads = set()
     self.thread_count = thread_count
-  
+    self.max_size = max_size
+    self.rejection_policy = rejection_policy
+    self.idle_timeout = idle_timeout
+    #[lock, idle since, thread] for each idle thread, most recently idle last
+    self.__waiters = []
+    self.__sequence = count()
+    self.__completed = 0
+    self.__rejected = 0
+    self.__wait_time = 0.0
+    self.__run_time = 0.0
+
   def add_task(self, fn, *args, **kwargs):
     '''Add the function ``fn`` to the queue to be invoked with
     ``args`` and ``kwargs`` as arguments. If the ``TaskQueue``
     is not currently running, it will be started now.
     '''
-    self.tasks.append((fn, args, kwargs))
-    self.lock.acquire()
-    self.run()
-    self.lock.release()
+    self.schedule(fn, args, kwargs)
+
+  def submit(self, fn, *args, **kwargs):
+    '''Like ``add_task`` but returns a ``Future`` that will be resolved with the return value of
+    ``fn`` (or the exception it raises).
+    '''
+    return self.schedule(fn, args, kwargs, future=Future())
+
+  def schedule(self, fn, args=(), kwargs=None, priority=0, future=None):
+    '''Add ``fn`` to the queue with ``priority`` to be invoked with ``args`` and ``kwargs``. If ``future`` is
+    set, it will be resolved with the return value of ``fn`` (or the exception it raises) and returned.
+    '''
+    task = (-priority, next(self.__sequence), time(), fn, args, kwargs or {}, future)
+    with self.lock:
+      if self.max_size > 0 and len(self.tasks) >= self.max_size:
+        self.__rejected += 1
+        if self.rejection_policy == 'caller_runs':
+          task = None
+        elif self.rejection_policy == 'discard_oldest':
+          discarded = max(self.tasks, key=lambda t: (t[0], -t[1]))
+          self.tasks.remove(discarded)
+          heapify(self.tasks)
+          if discarded[6]:
+            discarded[6].set_exception(TotoException(ERROR_LIMIT_EXCEEDED, "Task discarded"))
+        else:
+          raise TotoException(ERROR_LIMIT_EXCEEDED, "Task queue full")
+      if task:
+        heappush(self.tasks, task)
+        self.run()
+    if not task:
+      self.__run_task((0, 0, time(), fn, args, kwargs or {}, future))
+    return future
 
   def run(self):
     '''Start processing jobs in the queue. You should not need
     to call this as ``add_task`` automatically starts the queue.
     Processing threads will stop when there are no jobs available
-    in the queue.
+    in the queue for ``idle_timeout`` seconds. Must be called with
+    ``lock`` held.
     '''
+    self.running = True
+    if self.idle_timeout:
+      expired = time() - self.idle_timeout
+      while self.__waiters and self.__waiters[0][1] < expired:
+        waiter = self.__waiters.pop(0)
+        waiter[1] = None
+        self.threads.discard(waiter[2])
+        waiter[0].release()
+    #wake the most recently idle thread, or start a new one
+    if self.__waiters:
+      self.__waiters.pop()[0].release()
+      return
     if len(self.threads) >= self.thread_count:
       return
-    thread = None
     def task_loop():
       while 1:
-        self.lock.acquire()
-        try:
-          task = self.tasks.popleft()
-        except IndexError:
-          self.threads.remove(thread)
+        with self.lock:
+          if self.tasks:
+            task = heappop(self.tasks)
+          else:
+            task = None
+            waiter = [Lock(), time(), thread]
+            waiter[0].acquire()
+            self.__waiters.append(waiter)
+        if task:
+          self.__run_task(task)
+          continue
+        waiter[0].acquire()
+        if waiter[1] is None:
+          #expired by run()
           return
-        except Exception as e:
-          logging.error(traceback.format_exc())
-        finally:
-          self.lock.release()
-        task[0](*task[1], **task[2])
     thread = Thread(target=task_loop)
     thread.daemon = True
     self.threads.add(thread)
     thread.start()
 
+  def __run_task(self, task):
+    started = time()
+    future = task[6]
+    try:
+      result = task[3](*task[4], **task[5])
+      if future:
+        future.set_result(result)
+    except Exception as e:
+      if future:
+        future.set_exception(e)
+      else:
+        logging.error(traceback.format_exc())
+    finished = time()
+    with self.lock:
+      self.__completed += 1
+      self.__wait_time += started - task[2]
+      self.__run_time += finished - started
+
+  def stats(self):
+    '''Returns a dictionary with the number of threads (and how many are idle), the number of queued tasks,
+    the number of completed and rejected tasks, and the average time tasks waited in the queue and ran for
+    (in seconds).
+    '''
+    with self.lock:
+      completed = self.__completed or 1
+      return {'threads': len(self.threads), 'idle': len(self.__waiters), 'queued': len(self.tasks), 'completed': self.__completed, 'rejected': self.__rejected, 'average_wait': self.__wait_time / completed, 'average_run': self.__run_time / completed}
+
   def __len__(self):
     '''Returns the number of active threads plus the number of
     queued tasks/'''
-    return len(self.threads) + len(self.tasks)
+    return len(self.threads) - len(self.__waiters) + len(self.tasks)
 
   @classmethod
-  def instance(cls, name, thread_count=1):
+  def instance(cls, name, thread_count=1, **kwargs):
     '''A convenience method for accessing shared instances of ``TaskQueue``.
     If ``name`` references an existing instance created with this method,
     that instance will be returned. Otherwise, a new ``TaskQueue`` will be
-    instantiated with ``thread_count`` threads and stored under ``name``.
+    instantiated with ``thread_count`` threads (and any other ``kwargs``)
+    and stored under ``name``.
     '''
     if not hasattr(cls, '_task_queues'):
       cls._task_queues = {}
     try:
       return cls._task_queues[name]
     except KeyError:
-      cls._task_queues[name] = cls(thread_count)
+      cls._task_queues[name] = cls(thread_count, **kwargs)
       return cls._task_queues[name]
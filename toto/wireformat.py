@@ -0,0 +1,170 @@
+'''``toto.wireformat`` implements the framed message format used by events and worker tasks when the server
+is run with ``--wire_format=framed``. Each message starts with a small header::
+
+  magic (4 bytes) | version (1 byte) | serializer id (1 byte) | codec id (1 byte) | name length (2 bytes) | name
+
+followed by the payload. The name is the event name or the task method, so ``peek()`` can read it without
+touching the payload. The payload is serialized with ``--wire_serializer`` and only compressed with
+``--wire_compression`` when it is at least ``--wire_compression_threshold`` bytes long and compression
+actually makes it smaller.
+
+Legacy messages (``cPickle`` with optional compression) are told apart by the header: a message is only
+treated as framed if it starts with the four byte magic and has a supported version, known serializer and
+codec ids and a name that fits in the message. Legacy payloads compressed with a codec whose output can start
+with any byte (e.g. snappy or lz4 via ``--compression_module``) are very unlikely to pass all of these checks,
+so receivers accept both formats. To switch a running cluster, deploy this version everywhere with the default
+``--wire_format=legacy``, then enable ``framed`` on senders. Workers always reply in the format, serializer
+and codec of the request they received.
+'''
+
+import struct
+import zlib
+import json
+import logging
+import cPickle as pickle
+from tornado.options import define, options
+
+define("wire_format", default='legacy', metavar='legacy|framed', help="The message format used to send events and worker tasks. Framed and legacy messages are always accepted")
+define("wire_serializer", default='msgpack', metavar='msgpack|pickle|json', help="The serializer used for framed messages. Falls back to pickle if msgpack is not installed")
+define("wire_compression", default='zlib', metavar='zlib|lz4|snappy|none', help="The compression codec used for framed messages larger than wire_compression_threshold")
+define("wire_compression_threshold", default=1024, help="Framed message payloads smaller than this number of bytes will not be compressed")
+
+MAGIC = '\xf7TOT'
+VERSION = 1
+
+#worker replies that are part of a stream end with one of these frames
+STREAM_ITEM = '\x01'
+STREAM_END = '\x02'
+STREAM_ERROR = '\x03'
+
+#sent by the worker proxy in place of a reply when it abandons a task after --worker_max_attempts attempts
+TASK_FAILED = '\x04'
+
+_header = struct.Struct('!4sBBBH')
+
+class _Serializer(object):
+
+  def __init__(self, id, name, dumps, loads):
+    self.id = id
+    self.name = name
+    self.dumps = dumps
+    self.loads = loads
+
+class _Codec(object):
+
+  def __init__(self, id, name, compress, decompress):
+    self.id = id
+    self.name = name
+    self.compress = compress
+    self.decompress = decompress
+
+_serializers = {}
+_codecs = {}
+
+def register_serializer(id, name, dumps, loads):
+  '''Make the serializer ``name`` available for framed messages. ``id`` is written to the message header and
+  must be the same on every peer.
+  '''
+  _serializers[id] = _serializers[name] = _Serializer(id, name, dumps, loads)
+
+def register_codec(id, name, compress, decompress):
+  '''Make the compression codec ``name`` available for framed messages. ``id`` is written to the message header
+  and must be the same on every peer.
+  '''
+  _codecs[id] = _codecs[name] = _Codec(id, name, compress, decompress)
+
+register_serializer(0, 'pickle', lambda obj: pickle.dumps(obj, pickle.HIGHEST_PROTOCOL), pickle.loads)
+register_serializer(2, 'json', json.dumps, json.loads)
+register_codec(0, 'none', None, None)
+register_codec(1, 'zlib', lambda data: zlib.compress(data, 1), zlib.decompress)
+try:
+  import msgpack
+  register_serializer(1, 'msgpack', msgpack.dumps, msgpack.loads)
+except ImportError:
+  pass
+try:
+  import lz4.block
+  register_codec(2, 'lz4', lz4.block.compress, lz4.block.decompress)
+except ImportError:
+  pass
+try:
+  import snappy
+  register_codec(3, 'snappy', snappy.compress, snappy.decompress)
+except ImportError:
+  pass
+
+def _name_bytes(name):
+  return isinstance(name, unicode) and name.encode('utf-8') or (name or '')
+
+class WireFormat(object):
+  '''Encodes framed messages with the serializer and codec named by ``serializer`` and ``codec``. Payloads
+  shorter than ``threshold`` bytes are not compressed.
+  '''
+
+  def __init__(self, serializer='msgpack', codec='zlib', threshold=1024):
+    if serializer not in _serializers:
+      logging.warning("Serializer '%s' is not available, falling back to pickle" % serializer)
+      serializer = 'pickle'
+    if codec not in _codecs:
+      logging.warning("Compression codec '%s' is not available, falling back to zlib" % codec)
+      codec = 'zlib'
+    self.serializer = _serializers[serializer]
+    self.codec = _codecs[codec]
+    self.threshold = threshold
+
+  def encode(self, name, obj):
+    '''Returns a framed message containing ``name`` and the serialized ``obj``.'''
+    payload = self.serializer.dumps(obj)
+    codec = _codecs[0]
+    if self.codec.compress and len(payload) >= self.threshold:
+      compressed = self.codec.compress(payload)
+      if len(compressed) < len(payload):
+        payload, codec = compressed, self.codec
+    name = _name_bytes(name)
+    return ''.join((_header.pack(MAGIC, VERSION, self.serializer.id, codec.id, len(name)), name, payload))
+
+  @classmethod
+  def for_message(cls, data):
+    '''Returns a ``WireFormat`` that encodes messages with the serializer and codec used by the framed message ``data``.'''
+    magic, version, serializer_id, codec_id, name_length = _header.unpack_from(data)
+    if not hasattr(cls, '_formats'):
+      cls._formats = {}
+    key = (serializer_id, codec_id)
+    if key not in cls._formats:
+      #uncompressed messages don't identify the sender's codec, so use our own
+      codec = codec_id and _codecs[codec_id].name or options.wire_compression
+      cls._formats[key] = cls(_serializers[serializer_id].name, codec, options.wire_compression_threshold)
+    return cls._formats[key]
+
+  @classmethod
+  def instance(cls):
+    '''Returns the ``WireFormat`` configured with ``tornado.options``, or ``None`` if ``--wire_format`` is
+    "legacy".
+    '''
+    if options.wire_format != 'framed':
+      return None
+    if not hasattr(cls, '_instance'):
+      cls._instance = cls(options.wire_serializer, options.wire_compression, options.wire_compression_threshold)
+    return cls._instance
+
+def is_framed(data):
+  '''Returns ``True`` if ``data`` is a framed message.'''
+  if data[:len(MAGIC)] != MAGIC or len(data) < _header.size:
+    return False
+  magic, version, serializer_id, codec_id, name_length = _header.unpack_from(data)
+  return 0 < version <= VERSION and serializer_id in _serializers and codec_id in _codecs and _header.size + name_length <= len(data)
+
+def peek(data):
+  '''Returns the name stored in the header of the framed message ``data`` without decoding the payload.'''
+  name_length = _header.unpack_from(data)[4]
+  return data[_header.size:_header.size + name_length]
+
+def decode(data):
+  '''Returns the ``(name, obj)`` pair stored in the framed message ``data``.'''
+  magic, version, serializer_id, codec_id, name_length = _header.unpack_from(data)
+  if version > VERSION:
+    raise ValueError("Unsupported wire format version: %s" % version)
+  payload = data[_header.size + name_length:]
+  if codec_id:
+    payload = _codecs[codec_id].decompress(payload)
+  return data[_header.size:_header.size + name_length], _serializers[serializer_id].loads(payload)
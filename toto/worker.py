@@ -8,54 +8,68 @@ import zlib
 import cPickle as pickle
 import sys
 import time
+import signal
 from threading import Thread
+from types import GeneratorType
 from multiprocessing import Process, cpu_count
 from toto.service import TotoService, process_count, pid_path
 from toto.dbconnection import configured_connection
+from toto.wireformat import WireFormat
+import toto.wireformat as wireformat
+from toto.workerbroker import WorkerBroker
+from toto.methodregistry import MethodRegistry, load_manifest
+from toto.exceptions import *
+import toto.workerbroker as workerbroker
 
 define("method_module", default='methods', help="The root module to use for method lookup")
+define("method_manifest", default='', help="The path to a JSON method manifest (see toto.methodregistry). If set, method modules are imported the first time each method is called instead of at startup. Options defined in those modules can only be given their defaults")
 define("remote_event_receivers", type=str, help="A comma separated list of remote event address that this event manager should connect to. e.g.: 'tcp://192.168.1.2:8889'", multiple=True)
+define("event_routing", default='broadcast', metavar='broadcast|subscription', help="The event routing used by the servers receiving events from this worker")
 define("event_init_module", default=None, type=str, help="If defined, this module's 'invoke' function will be called with the EventManager instance after the main event handler is registered (e.g.: myevents.setup)")
 define("startup_function", default=None, type=str, help="An optional function to run on startup - e.g. module.function. The function will be called for each worker process after it is configured and before it starts listening for tasks with the named parameters worker and db_connection.")
 define("worker_address", default="tcp://*:55555", help="The service will bind to this address with a zmq PULL socket and listen for incoming tasks. Tasks will be load balanced to all workers. If this is set to an empty string, workers will connect directly to worker_socket_address.")
 define("worker_socket_address", default="ipc:///tmp/workerservice.sock", help="The load balancer will use this address to coordinate tasks between local workers")
 define("control_socket_address", default="ipc:///tmp/workercontrol.sock", help="Workers will subscribe to messages on this socket and listen for control commands. If this is an empty string, the command option will have no effect")
+define("worker_concurrency", default=0, help="If greater than zero, each worker process will run up to this many tasks at once. Synchronous tasks run on a pool of worker_concurrency threads and asynchronous tasks reply when they call respond(). If zero, each process runs one task at a time and asynchronous tasks are acknowledged immediately")
+define("worker_routing", default='queue', metavar='queue|broker', help="With 'queue', tasks are passed to worker processes round robin. With 'broker', tasks are only passed to workers with spare capacity, least loaded first, and workers are monitored with heartbeats. Brokered workers always run in concurrent mode with a concurrency of at least 1")
+define("worker_heartbeat_interval", default=1.0, help="The number of seconds between heartbeats when worker_routing is 'broker'")
+define("worker_heartbeat_liveness", default=3, help="With worker_routing set to 'broker', the broker and workers will consider each other lost after this many heartbeat intervals without a message")
 define("command", type=str, metavar='status|shutdown', help="Specify a command to send to running workers on the control socket")
 define("compression_module", type=str, help="The module to use for compressing and decompressing messages. The module must have 'decompress' and 'compress' methods. If not specified, no compression will be used. You can also set worker.compress and worker.decompress in your startup method for increased flexibility")
 define("serialization_module", type=str, help="The module to use for serializing and deserializing messages. The module must have 'dumps' and 'loads' methods. If not specified, cPickle will be used. You can also set worker.dumps and worker.loads in your startup method for increased flexibility")
 
 class TotoWorkerService(TotoService):
 
+  module_options = ('method_module', 'event_init_module')
+  function_options = ('startup_function',)
+
   def __init__(self, conf_file=None, **kwargs):
-    module_options = {'method_module', 'event_init_module'}
-    function_options = {'startup_function'}
-    original_argv, sys.argv = sys.argv, [i for i in sys.argv if i.strip('-').split('=')[0] in module_options]
-    self._load_options(conf_file, **{i: kwargs[i] for i in kwargs if i in module_options})
-    modules = {getattr(options, i) for i in module_options if getattr(options, i)}
-    for module in modules:
-      __import__(module)
-    function_modules = {getattr(options, i).rsplit('.', 1)[0] for i in function_options if getattr(options, i)}
-    for module in function_modules:
-      __import__(module)
-    sys.argv = original_argv
     #clear root logger handlers to prevent duplicate logging if user has specified a log file
     super(TotoWorkerService, self).__init__(conf_file, **kwargs)
-    #clear method_module references so we can fully reload with new options
-    for module in modules:
-      for i in (m for m in sys.modules.keys() if m.startswith(module)):
-        del sys.modules[i]
-    for module in function_modules:
-      for i in (m for m in sys.modules.keys() if m.startswith(module)):
-        del sys.modules[i]
-    #prevent the reloaded module from re-defining options
-    define, tornado.options.define = tornado.options.define, lambda *args, **kwargs: None
+    self.__configure()
+
+  def __configure(self):
     self.__event_init = options.event_init_module and __import__(options.event_init_module) or None
     self.__method_module = options.method_module and __import__(options.method_module) or None
-    tornado.options.define = define
+
+  def reload(self):
+    '''Reimport the method modules (and other modules named in options) so reloaded worker processes run the
+    latest code.
+    '''
+    self._reimport_modules()
+    self.__configure()
 
   def prepare(self):
     self.balancer = None
-    if options.worker_address:
+    if options.worker_address and options.worker_routing == 'broker':
+      broker = WorkerBroker(options.worker_address, options.worker_socket_address, options.worker_heartbeat_interval, options.worker_heartbeat_liveness)
+      self.balancer = Process(target=broker.run)
+      self.balancer.daemon = True
+      self.balancer.start()
+      if options.daemon:
+        with open(pid_path(0), 'wb') as f:
+          f.write(str(self.balancer.pid))
+    elif options.worker_address:
       self.balancer = ProcessDevice(zmq.QUEUE, zmq.ROUTER, zmq.DEALER)
       self.balancer.daemon = True
       self.balancer.bind_in(options.worker_address)
@@ -78,6 +92,8 @@ class TotoWorkerService(TotoService):
     if options.remote_event_receivers:
       from toto.events import EventManager
       event_manager = EventManager.instance()
+      event_manager.routing = options.event_routing
+      event_manager.wire_format = WireFormat.instance()
       if options.remote_instances:
         for address in options.remote_event_receivers.split(','):
           event_manager.register_server(address)
@@ -86,10 +102,11 @@ class TotoWorkerService(TotoService):
         init_module.invoke(event_manager)
     serialization = options.serialization_module and __import__(options.serialization_module) or pickle
     compression = options.compression_module and __import__(options.compression_module)
-    worker = TotoWorker(self.__method_module, options.worker_socket_address, db_connection, compression, serialization)
+    worker = TotoWorker(self.__method_module, options.worker_socket_address, db_connection, compression, serialization, options.worker_concurrency, options.worker_address and options.worker_routing or 'queue', options.worker_heartbeat_interval, options.worker_heartbeat_liveness)
     if options.startup_function:
       startup_path = options.startup_function.rsplit('.')
       __import__(startup_path[0]).__dict__[startup_path[1]](worker=worker, db_connection=db_connection)
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
     worker.start()
 
   def send_worker_command(self, command):
@@ -107,12 +124,20 @@ class TotoWorkerService(TotoService):
     super(TotoWorkerService, self).run()
 
 class TotoWorker():
-  def __init__(self, method_module, socket_address, db_connection, compression=None, serialization=None):
+  def __init__(self, method_module, socket_address, db_connection, compression=None, serialization=None, concurrency=0, routing='queue', heartbeat_interval=1.0, heartbeat_liveness=3):
     self.context = zmq.Context()
+    #brokered workers always run in concurrent mode so they can announce capacity and heartbeat
+    self.concurrency = routing == 'broker' and max(concurrency, 1) or concurrency
+    self.routing = routing
+    self.heartbeat_interval = heartbeat_interval
+    self.heartbeat_liveness = heartbeat_liveness
+    self.io_loop = None
+    self.__drain = None
     self.socket_address = socket_address
     self.method_module = method_module
+    self.method_registry = MethodRegistry(method_module, manifest=options.method_manifest and load_manifest(options.method_manifest) or None) if method_module else None
     self.db_connection = db_connection
-    self.db = db_connection and db_connection.db or None
+    self.db = db_connection.db if db_connection is not None else None
     self.status = 'Initialized'
     self.running = False
     self.compress = compression and compression.compress or (lambda x: x)
@@ -132,6 +157,21 @@ class TotoWorker():
     logging.error(err_string)
     return err_string
 
+  def __encode_legacy(self, name, obj):
+    return self.compress(self.dumps(obj))
+
+  def __decode_task(self, message):
+    if wireformat.is_framed(message):
+      #reply in the format of the request so old and new callers can share workers
+      method_name, parameters = wireformat.decode(message)
+      return {'method': method_name, 'parameters': parameters}, WireFormat.for_message(message).encode
+    return self.loads(self.decompress(message)), self.__encode_legacy
+
+  def __get_method(self, name):
+    if self.method_registry is None:
+      raise TotoException(ERROR_MISSING_METHOD, "Missing method: %s" % name)
+    return self.method_registry.resolve(name)
+
   def log_status(self):
     logging.info('Pid: %s status: %s' % (os.getpid(), self.status))
   
@@ -146,7 +186,10 @@ class TotoWorker():
           logging.info("Received command: %s" % command)
           if command == 'shutdown':
             self.running = False
-            self.context.term()
+            if self.io_loop:
+              self.io_loop.add_callback(self.io_loop.stop)
+            else:
+              self.context.term()
             return
           elif command == 'status':
             self.log_status()
@@ -157,24 +200,37 @@ class TotoWorker():
       thread.daemon = True
       thread.start()
 
+  def stop(self):
+    '''Stop taking new tasks and return from ``start()`` once the tasks in progress have finished or
+    ``--drain_timeout`` seconds have passed. This method may be called from a signal handler.
+    '''
+    self.running = False
+    if self.io_loop and self.__drain:
+      getattr(self.io_loop, 'add_callback_from_signal', self.io_loop.add_callback)(self.__drain)
+
   def start(self):
     self.running = True
     self.__monitor_control()
+    if self.concurrency > 0 or self.routing == 'broker':
+      self.__start_concurrent()
+      return
     socket = self.context.socket(zmq.REP)
     socket.connect(self.socket_address)
     pending_reply = False
+    encode = self.__encode_legacy
     while self.running:
       try:
         self.status = 'Listening'
+        #wake up regularly so stop() is noticed while idle
+        if not socket.poll(1000):
+          continue
         message = socket.recv_multipart()
         pending_reply = True
         message_id = message[0]
-        data = self.loads(self.decompress(message[1]))
+        data, encode = self.__decode_task(message[1])
         logging.info('Received Task %s: %s' % (message_id, data['method']))
-        method = self.method_module
-        for i in data['method'].split('.'):
-          method = getattr(method, i)
-        if hasattr(method.invoke, 'asynchronous'):
+        method = self.__get_method(data['method'])
+        if method.asynchronous:
           socket.send_multipart((message_id,))
           pending_reply = False
           self.status = 'Working'
@@ -182,12 +238,185 @@ class TotoWorker():
         else:
           self.status = 'Working'
           response = method.invoke(self, data['parameters'])
-          socket.send_multipart((message_id, self.compress(self.dumps(response))))
+          if isinstance(response, GeneratorType):
+            #a REP socket can only send one reply, so streamed results are sent all at once
+            socket.send_multipart((message_id, encode('', list(response)), wireformat.STREAM_END))
+          else:
+            socket.send_multipart((message_id, encode('', response)))
           pending_reply = False
       except Exception as e:
         err_string = self.log_error(e)
         if pending_reply:
-          socket.send_multipart((message_id, self.compress(self.dumps(err_string))))
+          socket.send_multipart((message_id, encode('', err_string)))
+
+    self.status = 'Finished'
+    self.log_status()
+
+  def __start_concurrent(self):
+    from zmq.eventloop.ioloop import IOLoop, PeriodicCallback
+    from zmq.eventloop.zmqstream import ZMQStream
+    from toto.tasks import TaskQueue
+    self.io_loop = IOLoop()
+    task_queue = TaskQueue(self.concurrency)
+    brokered = self.routing == 'broker'
+    state = {'active': 0, 'stream': None, 'broker_expires': 0, 'draining': False}
+
+    def connect():
+      if state['stream']:
+        state['stream'].close()
+      socket = self.context.socket(zmq.DEALER)
+      socket.setsockopt(zmq.LINGER, 0)
+      socket.connect(self.socket_address)
+      state['stream'] = ZMQStream(socket, self.io_loop)
+      state['stream'].on_recv(receive)
+      if brokered:
+        state['broker_expires'] = time.time() + self.heartbeat_interval * self.heartbeat_liveness
+        state['stream'].send_multipart((workerbroker.READY, str(self.concurrency)))
+
+    def heartbeat():
+      if state['broker_expires'] < time.time():
+        logging.warning('Lost connection to broker, reconnecting')
+        connect()
+      else:
+        state['stream'].send(workerbroker.HEARTBEAT)
+
+    def send(reply):
+      state['stream'].send_multipart(brokered and [workerbroker.REPLY] + reply or reply)
 
+    def task_done(reply):
+      send(reply)
+      state['active'] -= 1
+      if not brokered and not state['draining'] and state['active'] == self.concurrency - 1:
+        state['stream'].on_recv(receive)
+      self.status = state['active'] and 'Working' or 'Listening'
+
+    def receive(message):
+      if brokered:
+        #the broker only sends as many tasks as we have capacity for, so there is no need to pause
+        state['broker_expires'] = time.time() + self.heartbeat_interval * self.heartbeat_liveness
+        if message[0] != workerbroker.TASK:
+          return
+        message = message[1:]
+      #the frames before the empty delimiter route the reply back to the caller
+      delimiter = message.index('')
+      envelope, message_id = message[:delimiter + 1], message[delimiter + 1]
+      state['active'] += 1
+      if not brokered and state['active'] >= self.concurrency:
+        state['stream'].stop_on_recv()
+      self.status = 'Working'
+      try:
+        data, encode = self.__decode_task(message[delimiter + 2])
+        logging.info('Received Task %s: %s' % (message_id, data['method']))
+        method = self.__get_method(data['method'])
+      except Exception as e:
+        err_string = self.log_error(e)
+        task_done(envelope + [message_id, self.__encode_legacy('', err_string)])
+        return
+      def reply(response, flag=None):
+        frames = envelope + [message_id, encode('', response)] + (flag and [flag] or [])
+        def send_reply():
+          if flag == wireformat.STREAM_ITEM:
+            send(frames)
+          else:
+            task_done(frames)
+        self.io_loop.add_callback(send_reply)
+      task = WorkerTask(self, reply)
+      if method.asynchronous:
+        try:
+          method.invoke(task, data['parameters'])
+        except Exception as e:
+          task.respond(error=e)
+      else:
+        task_queue.add_task(task.run, method.invoke, data['parameters'])
+
+    def drain():
+      if state['draining']:
+        return
+      state['draining'] = True
+      self.status = 'Draining'
+      #tasks that were already routed to this worker but not received are left to the client's retry logic
+      if brokered:
+        heartbeats.stop()
+        state['stream'].send(workerbroker.DISCONNECT)
+      else:
+        state['stream'].stop_on_recv()
+      deadline = time.time() + options.drain_timeout
+      def check():
+        if state['active'] and time.time() < deadline:
+          self.io_loop.add_timeout(time.time() + 0.1, check)
+          return
+        self.io_loop.stop()
+      check()
+    self.__drain = drain
+
+    heartbeats = PeriodicCallback(heartbeat, self.heartbeat_interval * 1000, io_loop=self.io_loop)
+    connect()
+    if brokered:
+      heartbeats.start()
+    self.status = 'Listening'
+    if not self.running:
+      drain()
+    self.io_loop.start()
+    #give the last replies time to be sent
+    state['stream'].flush()
+    state['stream'].socket.setsockopt(zmq.LINGER, 1000)
+    state['stream'].close()
+    self.context.term()
     self.status = 'Finished'
     self.log_status()
+
+class WorkerTask(object):
+  '''In concurrent mode (``--worker_concurrency`` greater than zero), method invoke functions are passed a ``WorkerTask``
+  in place of the ``TotoWorker``. Any attributes not defined here are read from the worker. Methods decorated with
+  ``@asynchronous`` must call ``respond()`` when they are done, the reply is sent to the caller at that point.
+  ``respond()`` may be called from any thread.
+
+  Results can be streamed to callers using ``WorkerConnection.invoke_stream()``. Synchronous methods stream
+  results by returning a generator, each item is sent to the caller as soon as it is produced. Asynchronous
+  methods call ``respond_item()`` for each item and ``respond()`` to end the stream. Outside of concurrent mode,
+  generators are consumed completely and all items are sent to the caller at once.
+  '''
+
+  def __init__(self, worker, reply):
+    self._worker = worker
+    self._reply = reply
+    self.finished = False
+    self.streaming = False
+
+  def __getattr__(self, name):
+    return getattr(self._worker, name)
+
+  def respond(self, result=None, error=None):
+    '''Send ``result`` to the caller or, if ``error`` is set, the error string logged for ``error``. If items have
+    been streamed with ``respond_item()``, this ends the stream and ``result`` (if not ``None``) is sent as the
+    last item.
+    '''
+    if self.finished:
+      return
+    self.finished = True
+    if error is not None:
+      self._reply(self._worker.log_error(error), self.streaming and wireformat.STREAM_ERROR or None)
+    elif self.streaming:
+      self._reply(result is not None and [result] or [], wireformat.STREAM_END)
+    else:
+      self._reply(result)
+
+  def respond_item(self, item):
+    '''Stream ``item`` to the caller. Call ``respond()`` when there are no more items.'''
+    if self.finished:
+      return
+    self.streaming = True
+    self._reply(item, wireformat.STREAM_ITEM)
+
+  def run(self, fn, parameters):
+    try:
+      result = fn(self, parameters)
+      if isinstance(result, GeneratorType):
+        self.streaming = True
+        for item in result:
+          self.respond_item(item)
+        result = None
+    except Exception as e:
+      self.respond(error=e)
+      return
+    self.respond(result)
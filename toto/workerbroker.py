@@ -0,0 +1,134 @@
+'''``WorkerBroker`` replaces the ``zmq.QUEUE`` device between ``WorkerConnection`` clients and worker processes
+when the worker service is run with ``--worker_routing=broker``. Instead of handing tasks to workers round robin,
+the broker only sends a worker as many tasks as it has announced capacity for and always picks the least loaded
+worker, so a long running task never holds up tasks that an idle worker could run. Tasks are queued in the broker
+until a worker has capacity.
+
+Workers connect to ``backend_address`` with a ``DEALER`` socket and talk to the broker with these messages::
+
+  READY capacity                      worker -> broker, sent on connect
+  HEARTBEAT                           both directions, every heartbeat_interval seconds
+  TASK envelope... '' message_id task broker -> worker
+  REPLY envelope... '' message_id reply worker -> broker
+  DISCONNECT                          worker -> broker, sent when a worker stops taking tasks (e.g. on SIGTERM)
+
+A worker that has not been heard from for ``heartbeat_liveness`` intervals is dropped, and any tasks it was
+running are left to the client's retry logic. A worker that disconnects is sent no more tasks, but replies to
+the tasks it is still running are passed on. Workers that stop hearing the broker's heartbeats reconnect
+and announce themselves again, so either side can be restarted independently.
+'''
+
+import zmq
+import logging
+from collections import deque
+from time import time
+from wireformat import STREAM_ITEM
+
+READY = '\x01'
+HEARTBEAT = '\x02'
+REPLY = '\x03'
+TASK = '\x04'
+DISCONNECT = '\x05'
+
+class _Worker(object):
+
+  def __init__(self, identity, capacity, expires):
+    self.identity = identity
+    self.capacity = capacity
+    self.active = 0
+    self.expires = expires
+
+  @property
+  def load(self):
+    return float(self.active) / self.capacity
+
+class WorkerBroker(object):
+  '''Routes tasks received on ``frontend_address`` to the workers connected to ``backend_address``. Call
+  ``run()`` to start routing. ``run()`` does not return until ``stop()`` is called.
+  '''
+
+  def __init__(self, frontend_address, backend_address, heartbeat_interval=1.0, heartbeat_liveness=3):
+    self.frontend_address = frontend_address
+    self.backend_address = backend_address
+    self.heartbeat_interval = heartbeat_interval
+    self.heartbeat_liveness = heartbeat_liveness
+    self.running = False
+    self.__workers = {}
+    self.__queue = deque()
+    self.__frontend = None
+    self.__backend = None
+
+  def stats(self):
+    '''Returns the number of queued tasks and the capacity and number of active tasks of each connected worker.'''
+    return {'queued': len(self.__queue), 'workers': dict((w.identity, {'capacity': w.capacity, 'active': w.active}) for w in self.__workers.itervalues())}
+
+  def __dispatch(self):
+    available = [w for w in self.__workers.itervalues() if w.active < w.capacity]
+    while self.__queue and available:
+      worker = min(available, key=lambda w: w.load)
+      self.__backend.send_multipart([worker.identity, TASK] + self.__queue.popleft())
+      worker.active += 1
+      if worker.active >= worker.capacity:
+        available.remove(worker)
+
+  def __receive_backend(self):
+    message = self.__backend.recv_multipart()
+    identity, command = message[0], message[1]
+    worker = self.__workers.get(identity)
+    expires = time() + self.heartbeat_interval * self.heartbeat_liveness
+    if command == READY:
+      #a worker announces itself on every (re)connect, so any tasks it was running are gone
+      self.__workers[identity] = _Worker(identity, max(int(message[2]), 1), expires)
+      logging.info('Worker %s ready with capacity %s' % (identity.encode('hex'), message[2]))
+    elif command == REPLY:
+      self.__frontend.send_multipart(message[2:])
+      #partial results of a stream don't free the worker, only the final reply does
+      flag = message[message.index('', 2) + 3:]
+      if worker and not (flag and flag[0] == STREAM_ITEM):
+        worker.active = max(worker.active - 1, 0)
+    elif command == DISCONNECT:
+      if self.__workers.pop(identity, None):
+        logging.info('Worker %s disconnected' % identity.encode('hex'))
+      return
+    elif command != HEARTBEAT:
+      logging.warning('Unknown command from worker %s: %r' % (identity.encode('hex'), command))
+    if worker:
+      worker.expires = expires
+
+  def __heartbeat(self):
+    now = time()
+    for worker in self.__workers.values():
+      if worker.expires < now:
+        logging.warning('Worker %s expired with %s active tasks' % (worker.identity.encode('hex'), worker.active))
+        del self.__workers[worker.identity]
+      else:
+        self.__backend.send_multipart([worker.identity, HEARTBEAT])
+    logging.debug('Broker status: %s' % self.stats())
+
+  def run(self):
+    context = zmq.Context()
+    self.__frontend = context.socket(zmq.ROUTER)
+    self.__frontend.bind(self.frontend_address)
+    self.__backend = context.socket(zmq.ROUTER)
+    self.__backend.bind(self.backend_address)
+    poller = zmq.Poller()
+    poller.register(self.__frontend, zmq.POLLIN)
+    poller.register(self.__backend, zmq.POLLIN)
+    next_heartbeat = time() + self.heartbeat_interval
+    self.running = True
+    while self.running:
+      events = dict(poller.poll(max(next_heartbeat - time(), 0) * 1000))
+      if self.__backend in events:
+        self.__receive_backend()
+      if self.__frontend in events:
+        self.__queue.append(self.__frontend.recv_multipart())
+      if time() >= next_heartbeat:
+        self.__heartbeat()
+        next_heartbeat = time() + self.heartbeat_interval
+      self.__dispatch()
+    self.__frontend.close()
+    self.__backend.close()
+    context.term()
+
+  def stop(self):
+    self.running = False
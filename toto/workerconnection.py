@@ -3,23 +3,40 @@ import zmq
 import cPickle as pickle
 import zlib
 import logging
-from threading import Thread
+from threading import Thread, Lock
 from tornado.options import options, define
 from collections import deque
-from zmq.eventloop.ioloop import ZMQPoller, IOLoop, PeriodicCallback
+from zmq.eventloop.ioloop import ZMQPoller, IOLoop
 from zmq.eventloop.zmqstream import ZMQStream
 from time import time
 from uuid import uuid4
+from heapq import heappush, heappop
 from traceback import format_exc
+from wireformat import WireFormat
+import workerproxy
+from exceptions import *
+from tasks import Future
+import wireformat
 
 define("worker_compression_module", type=str, help="The module to use for compressing and decompressing messages to workers. The module must have 'decompress' and 'compress' methods. If not specified, no compression will be used. Only the default instance will be affected")
 define("worker_serialization_module", type=str, help="The module to use for serializing and deserializing messages to workers. The module must have 'dumps' and 'loads' methods. If not specified, cPickle will be used. Only the default instance will be affected")
 define("worker_retry_ms", default=10000, help="The default worker (instance()) will wait at least this many milliseconds before retrying a request")
+define("worker_max_attempts", default=0, help="The default worker (instance()) will give up on a request after sending it this many times and call the request's errback with an ERROR_TIMEOUT error. If zero, requests are retried until they succeed")
+define("worker_retry_backoff", default=1.0, help="The default worker (instance()) will multiply the retry interval of a request by this factor after every attempt, e.g. 2.0 for exponential backoff. With 1.0, requests are retried every worker_retry_ms")
+define("worker_retry_max_ms", default=0, help="If greater than zero, the default worker (instance()) will never wait more than this many milliseconds between retries")
+define("worker_max_pending", default=0, help="If greater than zero, the default worker (instance()) will reject new requests with ERROR_LIMIT_EXCEEDED while this many requests are waiting for a response")
 define("worker_address", default='', help="This is the address that toto.workerconnection.invoke(method, params) will send tasks too (As specified in the worker conf file)")
 
 class WorkerConnection(object):
 
-  def __init__(self, address, retry_ms=10000, compression=None, serialization=None):
+  '''Sends tasks to the workers at ``address``. Requests that have not been answered after ``retry_ms`` milliseconds are
+  sent again, with the interval multiplied by ``retry_backoff`` after each attempt (up to ``retry_max_ms``). If
+  ``max_attempts`` is non-zero, requests are abandoned after that many attempts and their errback is called with
+  an ``ERROR_TIMEOUT`` error. If ``max_pending`` is non-zero, ``invoke()`` raises an ``ERROR_LIMIT_EXCEEDED`` error
+  while that many requests are waiting for a response.
+  '''
+
+  def __init__(self, address, retry_ms=10000, compression=None, serialization=None, wire_format=None, max_attempts=0, retry_backoff=1.0, retry_max_ms=0, max_pending=0):
     self.address = address
     self.message_address = 'inproc://WorkerConnection%s' % id(self)
     self.__context = zmq.Context()
@@ -28,32 +45,115 @@ class WorkerConnection(object):
     self.__thread = None
     self.__retry_ms = retry_ms
     self.__callbacks = {}
+    self.__errbacks = {}
+    self.__streams = {}
     self.__queued_messages = {}
     self.__message_timeouts = {}
+    self.__deadlines = []
+    self.__pending = 0
+    self.__pending_lock = Lock()
+    self.max_attempts = max_attempts
+    self.retry_backoff = retry_backoff
+    self.retry_max_ms = retry_max_ms
+    self.max_pending = max_pending
     self.__ioloop = None
     self.loads = serialization and serialization.loads or pickle.loads
     self.dumps = serialization and serialization.dumps or pickle.dumps
     self.compress = compression and compression.compress or (lambda x: x)
     self.decompress = compression and compression.decompress or (lambda x: x)
+    self.wire_format = wire_format
   
-  def invoke(self, method, parameters, callback=None, retry_ms=0):
-    self._queue_message(self.compress(self.dumps({'method': method, 'parameters': parameters})), callback, retry_ms)
+  def invoke(self, method, parameters, callback=None, retry_ms=0, errback=None, timeout=0, io_loop=None):
+    '''Send ``method`` and ``parameters`` to a worker. ``callback`` is called on this connection's thread with the
+    response. If the request is abandoned after ``max_attempts`` attempts (by this connection or by the worker
+    proxy), ``errback`` is called with the error instead.
+
+    If ``callback`` is not set, a ``toto.tasks.Future`` is returned instead. The future is resolved with the
+    response on ``io_loop`` (the main ``IOLoop`` by default), so its callbacks may safely respond to requests. If
+    ``timeout`` is non-zero, the request is abandoned and the future fails with ``ERROR_TIMEOUT`` if no response
+    arrives within ``timeout`` seconds.
+    '''
+    if self.wire_format:
+      message = self.wire_format.encode(method, parameters)
+    else:
+      message = self.compress(self.dumps({'method': method, 'parameters': parameters}))
+    if callback:
+      self._queue_message(message, callback, retry_ms, errback)
+      return None
+    future = Future(io_loop)
+    def fail(error):
+      future.set_exception(error)
+      if errback:
+        errback(error)
+    message_id = self._queue_message(message, future.set_result, retry_ms, fail)
+    if timeout > 0:
+      def expire():
+        self.cancel(message_id)
+        future.set_exception(TotoException(ERROR_TIMEOUT, "Timed out waiting for worker"))
+      handle = future.io_loop.add_timeout(time() + timeout, expire)
+      future.add_done_callback(lambda f: f.io_loop.remove_timeout(handle))
+    return future
+
+  def invoke_stream(self, method, parameters, retry_ms=0, io_loop=None):
+    '''Like ``invoke()`` but returns a ``WorkerStream`` that receives the results streamed by the worker as they are
+    produced. See ``toto.worker.WorkerTask`` for streaming results from a worker method. Requests are only retried
+    until the first result arrives.
+    '''
+    if self.wire_format:
+      message = self.wire_format.encode(method, parameters)
+    else:
+      message = self.compress(self.dumps({'method': method, 'parameters': parameters}))
+    stream = WorkerStream(self, io_loop)
+    stream.message_id = self._queue_message(message, None, retry_ms, stream._fail, stream)
+    return stream
+
+  def cancel(self, message_id):
+    '''Stop waiting for a response to the request with ``message_id``. Its callbacks will not be called.'''
+    def cancel():
+      self.__complete(message_id)
+    if self.__ioloop:
+      self.__ioloop.add_callback(cancel)
+
+  def __complete(self, message_id):
+    if self.__queued_messages.pop(message_id, None) is None:
+      return False
+    self.__message_timeouts.pop(message_id, None)
+    self.__callbacks.pop(message_id, None)
+    self.__errbacks.pop(message_id, None)
+    self.__streams.pop(message_id, None)
+    with self.__pending_lock:
+      self.__pending -= 1
+    return True
+
+  def _decode_response(self, data):
+    if wireformat.is_framed(data):
+      return wireformat.decode(data)[1]
+    return self.loads(self.decompress(data))
   
   def __len__(self):
-    return len(self.__queued_messages)
+    return self.__pending
 
   def __getattr__(self, path):
     return WorkerInvocation(path, self)
 
-  def _queue_message(self, message, callback=None, retry_ms=0):
+  def _queue_message(self, message, callback=None, retry_ms=0, errback=None, stream=None):
+    with self.__pending_lock:
+      if self.max_pending and self.__pending >= self.max_pending:
+        raise TotoException(ERROR_LIMIT_EXCEEDED, "Too many pending worker requests")
+      self.__pending += 1
     if not self.__ioloop:
       self.start()
     message_id = str(uuid4())
     if callback:
       self.__callbacks[message_id] = callback
+    if errback:
+      self.__errbacks[message_id] = errback
+    if stream:
+      self.__streams[message_id] = stream
     if retry_ms > 0:
       self.__message_timeouts[message_id] = retry_ms
     self.__queue_socket.send_multipart(('', message_id, message))
+    return message_id
   
   def log_error(self, error):
     logging.error(repr(error))
@@ -68,31 +168,94 @@ class WorkerConnection(object):
       worker_socket.connect(self.address)
       worker_stream = ZMQStream(worker_socket, self.__ioloop)
 
+      def receive_stream(stream, message):
+        message_id, flag = message[1], message[3:] and message[3] or None
+        if flag == wireformat.STREAM_ITEM:
+          item = self.__queued_messages.get(message_id)
+          if not item:
+            return
+          #clearing the deadline stops retries, replaying a partially received stream would duplicate results
+          self.__queued_messages[message_id] = (None,) + item[1:]
+        elif not self.__complete(message_id):
+          return
+        try:
+          stream._receive(self._decode_response(message[2]), flag)
+        except Exception as e:
+          self.log_error(e)
+
       def receive_response(message):
-        self.__queued_messages.pop(message[1], None)
-        self.__message_timeouts.pop(message[1], None)
-        callback = self.__callbacks.pop(message[1], None)
+        if message[3:] and message[3] == wireformat.TASK_FAILED:
+          fail_message(message[1], TotoException(ERROR_TIMEOUT, "Worker request abandoned by the worker proxy"))
+          return
+        stream = self.__streams.get(message[1])
+        if stream:
+          receive_stream(stream, message)
+          return
+        #duplicate responses to retried requests are ignored
+        callback = self.__callbacks.get(message[1])
+        if not self.__complete(message[1]):
+          return
         if callback:
           try:
-            callback(self.loads(self.decompress(message[2])))
+            callback(self._decode_response(message[2]))
           except Exception as e:
             self.log_error(e)
       worker_stream.on_recv(receive_response)
 
-      def queue_message(message):
-        self.__queued_messages[message[1]] = (time() * 1000, message)
+      timeout = {'deadline': None, 'handle': None}
+
+      def schedule(deadline):
+        if timeout['deadline'] is not None and timeout['deadline'] <= deadline:
+          return
+        if timeout['handle']:
+          self.__ioloop.remove_timeout(timeout['handle'])
+        timeout['deadline'] = deadline
+        timeout['handle'] = self.__ioloop.add_timeout(deadline / 1000.0, requeue_messages)
+
+      def send_message(message_id, attempts, delay):
+        message = self.__queued_messages[message_id][3]
+        deadline = time() * 1000 + delay
+        #the deadline is stored with the message so stale heap entries can be recognized and skipped
+        self.__queued_messages[message_id] = (deadline, attempts, delay, message)
+        heappush(self.__deadlines, (deadline, message_id))
+        schedule(deadline)
         try:
           worker_stream.send_multipart(message)
         except Exception as e:
           self.log_error(e)
+
+      def queue_message(message):
+        self.__queued_messages[message[1]] = (None, 0, 0, message)
+        send_message(message[1], 1, self.__message_timeouts.get(message[1], self.__retry_ms))
       queue_stream.on_recv(queue_message)
 
-      def requeue_message():
+      def fail_message(message_id, error):
+        errback = self.__errbacks.get(message_id)
+        if not self.__complete(message_id):
+          return
+        if errback:
+          try:
+            errback(error)
+          except Exception as e:
+            self.log_error(e)
+
+      def requeue_messages():
+        timeout['deadline'] = timeout['handle'] = None
         now = time() * 1000
-        for message in (item[1] for item in self.__queued_messages.itervalues() if item[0] + self.__message_timeouts.get(item[1][1], self.__retry_ms) < now):
-          queue_message(message)
-      requeue_callback = PeriodicCallback(requeue_message, self.__retry_ms, io_loop = self.__ioloop)
-      requeue_callback.start()
+        while self.__deadlines and self.__deadlines[0][0] <= now:
+          deadline, message_id = heappop(self.__deadlines)
+          item = self.__queued_messages.get(message_id)
+          if not item or item[0] != deadline:
+            continue
+          if self.max_attempts and item[1] >= self.max_attempts:
+            fail_message(message_id, TotoException(ERROR_TIMEOUT, "Worker request timed out after %s attempts" % self.max_attempts))
+            continue
+          delay = item[2] * self.retry_backoff
+          if self.retry_max_ms:
+            delay = min(delay, self.retry_max_ms)
+          send_message(message_id, item[1] + 1, delay)
+        if self.__deadlines:
+          schedule(self.__deadlines[0][0])
 
       self.__ioloop.start()
       self.__thread = None
@@ -118,17 +281,87 @@ class WorkerConnection(object):
   @classmethod
   def instance(cls):
     if not hasattr(cls, '_instance'):
-      cls._instance = cls(options.worker_address, retry_ms=options.worker_retry_ms, compression=options.worker_compression_module and __import__(options.worker_compression_module), serialization=options.worker_serialization_module and __import__(options.worker_serialization_module))
+      #the local proxy ignores resent requests that it is already retrying upstream
+      cls._instance = cls(options.worker_proxy_address or options.worker_address, retry_ms=options.worker_retry_ms, compression=options.worker_compression_module and __import__(options.worker_compression_module), serialization=options.worker_serialization_module and __import__(options.worker_serialization_module), wire_format=WireFormat.instance(), max_attempts=options.worker_max_attempts, retry_backoff=options.worker_retry_backoff, retry_max_ms=options.worker_retry_max_ms, max_pending=options.worker_max_pending)
     return cls._instance
 
+class WorkerStream(object):
+  '''The results streamed by a worker in response to ``WorkerConnection.invoke_stream()``. Call ``next_future()``
+  for a ``toto.tasks.Future`` that resolves to the next result. Once all results have been received, the future
+  fails with ``StopIteration``. Streams can be passed to ``TotoHandler.respond_stream()`` to forward results
+  to the client as they arrive.
+  '''
+
+  def __init__(self, connection, io_loop=None):
+    self.connection = connection
+    self.io_loop = io_loop
+    self.message_id = None
+    self.__items = deque()
+    self.__waiter = None
+    self.__error = None
+    self.__finished = False
+    self.__lock = Lock()
+
+  def next_future(self):
+    '''Returns a ``Future`` for the next result. If the previous future is still pending, it is returned again.'''
+    with self.__lock:
+      if self.__waiter:
+        return self.__waiter
+      future = Future(self.io_loop)
+      if self.__items:
+        future.set_result(self.__items.popleft())
+      elif self.__finished:
+        future.set_exception(self.__error or StopIteration())
+      else:
+        self.__waiter = future
+      return future
+
+  def close(self):
+    '''Stop receiving results. Pending futures will fail with ``StopIteration``.'''
+    if self.message_id:
+      self.connection.cancel(self.message_id)
+    self._receive([], wireformat.STREAM_END)
+
+  def _fail(self, error):
+    self._receive(error, wireformat.STREAM_ERROR)
+
+  def _receive(self, data, flag):
+    with self.__lock:
+      if self.__finished:
+        return
+      if flag == wireformat.STREAM_ITEM:
+        self.__items.append(data)
+      elif flag == wireformat.STREAM_END:
+        self.__items.extend(data)
+        self.__finished = True
+      elif flag == wireformat.STREAM_ERROR:
+        self.__error = isinstance(data, Exception) and data or TotoException(ERROR_SERVER, data)
+        self.__finished = True
+      else:
+        #methods that don't stream reply with a single result
+        self.__items.append(data)
+        self.__finished = True
+      waiter = self.__waiter
+      if not waiter:
+        return
+      self.__waiter = None
+      if self.__items:
+        result, error = self.__items.popleft(), None
+      else:
+        result, error = None, self.__error or StopIteration()
+    if error:
+      waiter.set_exception(error)
+    else:
+      waiter.set_result(result)
+
 class WorkerInvocation(object):
   
   def __init__(self, path, connection):
     self._path = path
     self._connection = connection
 
-  def __call__(self, parameters, callback=None, retry_ms=0):
-    self._connection.invoke(self._path, parameters, callback, retry_ms)
+  def __call__(self, parameters, callback=None, retry_ms=0, errback=None, timeout=0, io_loop=None):
+    return self._connection.invoke(self._path, parameters, callback, retry_ms, errback, timeout, io_loop)
 
   def __getattr__(self, path):
     return getattr(self._connection, self._path + '.' + path)
@@ -0,0 +1,135 @@
+'''``WorkerProxy`` lets all server processes on a host share their connections to the workers. When a server is run
+with ``--worker_proxy_address`` (e.g. "ipc:///tmp/workerproxy.sock"), ``TotoServer`` starts a proxy process that
+listens on that address and ``WorkerConnection.instance()`` sends tasks to the proxy instead of ``--worker_address``.
+The proxy passes tasks upstream over a pool of ``--worker_proxy_connections`` connections and routes replies
+(including streamed results) back to the process that sent each task.
+
+Retries are handled by the proxy for all local processes with the ``--worker_retry_ms``, ``--worker_retry_backoff``,
+``--worker_retry_max_ms`` and ``--worker_max_attempts`` options. Server processes still retry on their own schedule
+in case the proxy is restarted, tasks that are already in flight in the proxy are not sent upstream again. When the
+proxy gives up on a task, the server process that sent it calls the request's errback with an ``ERROR_TIMEOUT`` error.
+'''
+
+import zmq
+import logging
+from heapq import heappush, heappop
+from itertools import cycle
+from time import time
+from tornado.options import define, options
+from wireformat import STREAM_ITEM, TASK_FAILED
+
+define("worker_proxy_address", default='', help="If set, the server will start a proxy listening on this address (e.g. 'ipc:///tmp/workerproxy.sock') and all server processes will send worker tasks through it")
+define("worker_proxy_connections", default=1, help="The number of connections the worker proxy will open to worker_address")
+
+class _Task(object):
+
+  def __init__(self, route, message, delay):
+    self.route = route
+    self.message = message
+    self.attempts = 0
+    self.delay = delay
+    self.deadline = None
+
+class WorkerProxy(object):
+  '''Listens for tasks on ``address`` and sends them to ``upstream_address`` over ``connections`` sockets. Tasks
+  that are not answered are retried like ``WorkerConnection`` retries them. Call ``run()`` to start the proxy.
+  ``run()`` does not return until ``stop()`` is called.
+  '''
+
+  def __init__(self, address, upstream_address, connections=1, retry_ms=10000, retry_backoff=1.0, retry_max_ms=0, max_attempts=0):
+    self.address = address
+    self.upstream_address = upstream_address
+    self.connections = max(connections, 1)
+    self.retry_ms = retry_ms
+    self.retry_backoff = retry_backoff
+    self.retry_max_ms = retry_max_ms
+    self.max_attempts = max_attempts
+    self.running = False
+    self.__tasks = {}
+    self.__deadlines = []
+
+  def __len__(self):
+    return len(self.__tasks)
+
+  def __send(self, message_id, task):
+    task.attempts += 1
+    task.deadline = time() * 1000 + task.delay
+    heappush(self.__deadlines, (task.deadline, message_id))
+    next(self.__upstream).send_multipart(task.message)
+
+  def __receive_request(self, frontend):
+    message = frontend.recv_multipart()
+    delimiter = message.index('')
+    route, message_id = message[:delimiter], message[delimiter + 1]
+    task = self.__tasks.get(message_id)
+    if task:
+      #a retry from a server process, the proxy is already retrying the task upstream
+      task.route = route
+      return
+    task = _Task(route, message[delimiter:], self.retry_ms)
+    self.__tasks[message_id] = task
+    self.__send(message_id, task)
+
+  def __receive_reply(self, socket, frontend):
+    message = socket.recv_multipart()
+    message_id = message[1]
+    task = self.__tasks.get(message_id)
+    if not task:
+      return
+    if message[3:] and message[3] == STREAM_ITEM:
+      #partially received streams are not retried
+      task.deadline = None
+    else:
+      del self.__tasks[message_id]
+    frontend.send_multipart(task.route + message)
+
+  def __retry(self, frontend):
+    now = time() * 1000
+    while self.__deadlines and self.__deadlines[0][0] <= now:
+      deadline, message_id = heappop(self.__deadlines)
+      task = self.__tasks.get(message_id)
+      if not task or task.deadline != deadline:
+        continue
+      if self.max_attempts and task.attempts >= self.max_attempts:
+        logging.warning('Dropping worker task %s after %s attempts' % (message_id, task.attempts))
+        del self.__tasks[message_id]
+        #let the server process fail the request instead of waiting for a reply that will never come
+        frontend.send_multipart(task.route + ['', message_id, '', TASK_FAILED])
+        continue
+      task.delay *= self.retry_backoff
+      if self.retry_max_ms:
+        task.delay = min(task.delay, self.retry_max_ms)
+      self.__send(message_id, task)
+
+  def run(self):
+    context = zmq.Context()
+    frontend = context.socket(zmq.ROUTER)
+    frontend.bind(self.address)
+    upstream = []
+    poller = zmq.Poller()
+    poller.register(frontend, zmq.POLLIN)
+    for i in xrange(self.connections):
+      socket = context.socket(zmq.DEALER)
+      socket.connect(self.upstream_address)
+      poller.register(socket, zmq.POLLIN)
+      upstream.append(socket)
+    self.__upstream = cycle(upstream)
+    self.running = True
+    while self.running:
+      timeout = 1000
+      if self.__deadlines:
+        timeout = min(max(self.__deadlines[0][0] - time() * 1000, 0), timeout)
+      events = dict(poller.poll(timeout))
+      for socket in upstream:
+        if socket in events:
+          self.__receive_reply(socket, frontend)
+      if frontend in events:
+        self.__receive_request(frontend)
+      self.__retry(frontend)
+    for socket in upstream:
+      socket.close()
+    frontend.close()
+    context.term()
+
+  def stop(self):
+    self.running = False